@@ -1,18 +1,36 @@
 # encoding:utf-8
 
+import hmac
 import os
 import signal
 import sys
-from flask import Flask, request
+from flask import Flask, abort, jsonify, request
 
 from channel import channel_factory
 from common import const
-from config import load_config
+from common.wsgi_server import WSGIServer
+from config import conf, load_config
 from plugins import *
 import threading
 
 app = Flask(__name__)
 channels = {}
+server = None
+
+
+@app.route("/plugins/stats", methods=["GET"])
+def plugin_stats():
+    """
+    各插件处理事件的调用次数、耗时分位数、异常和中断次数，供监控采集
+    该接口与通道回调共用同一个服务端口，未配置plugin_stats_token时关闭，请求需携带Authorization: Bearer <token>头
+    """
+    token = conf().get("plugin_stats_token")
+    if not token:
+        abort(404)
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode("utf-8"), "Bearer {}".format(token).encode("utf-8")):
+        abort(401)
+    return jsonify(PluginManager().stats.stats())
 
 
 def sigterm_handler_wrap(_signo):
@@ -20,6 +38,8 @@ def sigterm_handler_wrap(_signo):
 
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
+        if server:
+            server.drain()
         conf().save_user_datas()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
@@ -47,31 +67,42 @@ def register_channel(channel_name: str):
     channels[channel_name] = channel
 
 
+def create_app():
+    """
+    加载配置并注册所有渠道，返回WSGI应用，也可用于 gunicorn -w 4 "app:create_app()"
+    """
+    # load config
+    load_config()
+
+    # create channels
+    channel_names = conf().get("channel_types", ["wx"])
+    if isinstance(channel_names, str):
+        channel_names = [channel_names]
+
+    if "--cmd" in sys.argv:
+        channel_names = ["terminal"]
+
+    for channel_name in channel_names:
+        if channel_name == "wxy":
+            os.environ["WECHATY_LOG"] = "warn"
+        register_channel(channel_name)
+    return app
+
+
 def run():
+    global server
     try:
-        # load config
-        load_config()
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
         sigterm_handler_wrap(signal.SIGTERM)
 
-        # create channels
-        channel_names = conf().get("channel_types", ["wx"])
-        if isinstance(channel_names, str):
-            channel_names = [channel_names]
-
-        if "--cmd" in sys.argv:
-            channel_names = ["terminal"]
-
-        for channel_name in channel_names:
-            if channel_name == "wxy":
-                os.environ["WECHATY_LOG"] = "warn"
-            register_channel(channel_name)
+        create_app()
 
         # Start web server
         port = conf().get("port", 8080)
-        app.run(host="0.0.0.0", port=port)
+        server = WSGIServer(app, "0.0.0.0", port)
+        server.serve_forever()
     except Exception as e:
         logger.error("App startup failed!")
         logger.exception(e)
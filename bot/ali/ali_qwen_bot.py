@@ -15,7 +15,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common import const, retry
 from config import conf, load_config
 
 class AliQwenBot(Bot):
@@ -23,6 +23,7 @@ class AliQwenBot(Bot):
         super().__init__()
         self.api_key_expired_time = self.set_api_key()
         self.sessions = SessionManager(AliQwenSession, model=conf().get("model", const.QWEN))
+        self.retry_policy = retry.RetryPolicy()
 
     def api_key_client(self):
         return broadscope_bailian.AccessTokenClient(access_key_id=self.access_key_id(), access_key_secret=self.access_key_secret())
@@ -100,50 +101,44 @@ class AliQwenBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
-        try:
-            prompt, history = self.convert_messages_format(session.messages)
-            self.update_api_key_if_expired()
-            # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
-            response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
-            completion_content = self.get_completion_content(response, self.node_id())
-            completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": completion_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[QWEN] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[QWEN] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[QWEN] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[QWEN] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.exception("[QWEN] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                prompt, history = self.convert_messages_format(session.messages)
+                self.update_api_key_if_expired()
+                # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
+                response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
+                completion_content = self.get_completion_content(response, self.node_id())
+                completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": completion_content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                kind = self.retry_policy.classify(e)
+                if kind == retry.RATE_LIMIT:
+                    logger.warn("[QWEN] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                elif kind == retry.TIMEOUT:
+                    logger.warn("[QWEN] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                elif kind == retry.SERVER:
+                    logger.warn("[QWEN] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                elif kind == retry.CONNECTION:
+                    logger.warn("[QWEN] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                else:
+                    logger.exception("[QWEN] Exception: {}".format(e))
+                    self.sessions.clear_session(session.session_id)
+
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[QWEN] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                time.sleep(retry_delay)
 
     def set_api_key(self):
         api_key, expired_time = self.api_key_client().create_token(agent_key=self.agent_key())
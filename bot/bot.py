@@ -2,6 +2,7 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Optional
 from bridge.context import Context
@@ -57,6 +58,16 @@ class Bot(IReply, IImageCreate, IImage2Text):
         """
         raise NotImplementedError
 
+    async def areply(self, query: str, context: Optional[Context] = None) -> Reply:
+        """
+        bot auto-reply content，异步版本
+        默认在线程池中执行reply，bot可以重写该方法，直接使用异步客户端请求模型
+        :param query: 用户输入内容
+        :param context: 上下文信息
+        :return: 回复内容
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.reply, query, context)
+
     def create_img(self, prompt: str, context: Optional[Context] = None) -> str:
         """
         根据文本生成图片
@@ -90,3 +101,10 @@ class Bot(IReply, IImageCreate, IImage2Text):
         :return: 如果实现了IImageCreate接口返回True，否则返回False
         """
         return not getattr(self.create_img, "__isabstractmethod__", False)
+
+    def has_async_reply(self) -> bool:
+        """
+        判断bot是否原生实现了areply，未实现时areply仍会占用线程
+        :return: 如果重写了areply返回True，否则返回False
+        """
+        return type(self).areply is not Bot.areply
@@ -1,19 +1,22 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
 import openai.error
 import requests
-from common import const
+from common import const, retry
 from bot.bot import Bot
-from bot.chatgpt.chat_gpt_session import ChatGPTSession
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, preload_token_counter
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.admission import TokenAdmission
+from common.endpoint_pool import Endpoint, EndpointPool
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.token_bucket import KeyedTokenBucket, create_token_bucket
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
@@ -28,10 +31,26 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
+        self.tb4chatgpt = None
+        self.tb4session = None
         if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+            self.tb4chatgpt = create_token_bucket("chatgpt", conf().get("rate_limit_chatgpt", 20))
+        if conf().get("rate_limit_chatgpt_per_session"):
+            self.tb4session = KeyedTokenBucket("chatgpt_session", conf().get("rate_limit_chatgpt_per_session"))
+        self.admission = None
+        if conf().get("rate_limit_chatgpt_tpm"):
+            self.admission = TokenAdmission(
+                "chatgpt",
+                conf().get("rate_limit_chatgpt_tpm"),
+                max_wait=conf().get("rate_limit_max_wait", 30),
+                completion_tokens=conf().get("rate_limit_completion_tokens", 500),
+            )
+        self.retry_policy = retry.RetryPolicy()
+        self.endpoint_pool = self._create_endpoint_pool()
         conf_model = conf().get("model") or "gpt-3.5-turbo"
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        # 提前加载tokenizer，避免首条消息计算token时才加载
+        preload_token_counter(conf_model)
         # o1相关模型不支持system prompt，暂时用文心模型的session
 
         self.args = {
@@ -54,53 +73,15 @@ class ChatGPTBot(Bot, OpenAIImage):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session, api_key, new_args = self._prepare_text_query(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            if context.get("stream"):
+                # reply in stream
+                return Reply(ReplyType.STREAM, self.reply_text_stream(session, api_key, args=new_args))
 
             reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_text_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -114,6 +95,69 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT or context.get("stream"):
+            return await super().areply(query, context)
+        # 会话读写和token计算是同步阻塞的，放到线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        reply, session, api_key, new_args = await loop.run_in_executor(None, self._prepare_text_query, query, context)
+        if reply:
+            return reply
+        reply_content = await self.areply_text(session, api_key, args=new_args)
+        return await loop.run_in_executor(None, self._build_text_reply, session, reply_content)
+
+    def _prepare_text_query(self, query, context):
+        """
+        处理清除记忆等命令，并把问题加入会话
+        :return: (命令的回复, session, api_key, args)，命令的回复不为空时直接返回给用户
+        """
+        logger.info("[CHATGPT] query={}".format(query))
+
+        session_id = context["session_id"]
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        if reply:
+            return reply, None, None, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return None, session, api_key, new_args
+
+    def _build_text_reply(self, session, reply_content):
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -122,53 +166,229 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        retry_state = self.retry_policy.start(retry_count)
+        # if api_key == None, the default openai.api_key will be used
+        if args is None:
+            args = self.args
+        while True:
+            reserved = self._admit(session, args)
+            if reserved is None:
+                return self._rejected_result()
+            endpoint, started_at = None, None
+            try:
+                if not self._acquire_token(session):
+                    raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+                endpoint, request_args = self._request_args(api_key, args)
+                started_at = time.monotonic()
+                response = openai.ChatCompletion.create(messages=session.messages, **request_args)
+                # 请求结束即释放节点，之后解析响应出错时不会再次释放
+                self._release_endpoint(endpoint, started_at)
+                endpoint = None
+                # logger.debug("[CHATGPT] response={}".format(response))
+                # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                result = self._parse_response(response)
+                self._reconcile(reserved, result["total_tokens"])
+                return result
+            except Exception as e:
+                self._release_endpoint(endpoint, started_at, e)
+                self._reconcile(reserved, 0)
+                result = self._handle_reply_error(e, session)
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[CHATGPT] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                time.sleep(retry_delay)
+
+    async def areply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        reply_text的异步版本，使用openai的异步接口，等待响应和重试间隔时不占用线程
+        """
+        retry_state = self.retry_policy.start(retry_count, blocking=False)
+        if args is None:
+            args = self.args
+        while True:
+            reserved = await self._aadmit(session, args)
+            if reserved is None:
+                return self._rejected_result()
+            endpoint, started_at = None, None
+            try:
+                if not await self._aacquire_token(session):
+                    raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+                endpoint, request_args = self._request_args(api_key, args)
+                started_at = time.monotonic()
+                response = await openai.ChatCompletion.acreate(messages=session.messages, **request_args)
+                self._release_endpoint(endpoint, started_at)
+                endpoint = None
+                result = self._parse_response(response)
+                await self._areconcile(reserved, result["total_tokens"])
+                return result
+            except Exception as e:
+                self._release_endpoint(endpoint, started_at, e)
+                await self._areconcile(reserved, 0)
+                result = self._handle_reply_error(e, session)
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[CHATGPT] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                await asyncio.sleep(retry_delay)
+
+    def _acquire_token(self, session) -> bool:
+        """
+        获取全局和会话的限流令牌，令牌不足时等待
+        """
+        if self.tb4chatgpt and not self.tb4chatgpt.get_token():
+            return False
+        if self.tb4session and not self.tb4session.get_token(session.session_id):
+            return False
+        return True
+
+    async def _aacquire_token(self, session) -> bool:
+        if self.tb4chatgpt and not await self.tb4chatgpt.aget_token():
+            return False
+        if self.tb4session and not await self.tb4session.aget_token(session.session_id):
+            return False
+        return True
+
+    @staticmethod
+    def _create_endpoint_pool() -> EndpointPool:
+        """
+        根据open_ai_endpoints配置创建api key/接口地址池，未配置时使用全局的open_ai_api_key
+        """
+        endpoints = []
+        for i, item in enumerate(conf().get("open_ai_endpoints") or []):
+            params = {k: v for k, v in item.items() if k != "weight" and v}
+            name = "{}#{}".format(params.get("api_base") or "default", i)
+            endpoints.append(Endpoint(name, params, item.get("weight", 1)))
+        if endpoints:
+            logger.info("[CHATGPT] use {} endpoints".format(len(endpoints)))
+        return EndpointPool(endpoints, eject_seconds=conf().get("endpoint_eject_seconds", 30))
+
+    def _request_args(self, api_key, args):
+        """
+        选择本次请求使用的节点，用户自己的api key优先
+        :return: (节点, 请求参数)，未使用节点池时节点为None，调用结束后需要调用_release_endpoint
+        """
+        if api_key or not len(self.endpoint_pool):
+            return None, dict(args, api_key=api_key)
+        endpoint = self.endpoint_pool.acquire()
+        request_args = dict(args, **endpoint.params)
+        # 节点未配置api_type时按openai节点请求，显式传入类型，不沿用AzureChatGPTBot设置的全局azure类型和deployment_id
+        request_args["api_type"] = endpoint.params.get("api_type", "open_ai")
+        if "azure" not in request_args["api_type"] and "deployment_id" not in endpoint.params:
+            request_args.pop("deployment_id", None)
+        return endpoint, request_args
+
+    def _release_endpoint(self, endpoint, started_at, error=None):
+        if endpoint:
+            remaining = EndpointPool.remaining_from_headers(getattr(error, "headers", None))
+            self.endpoint_pool.release(endpoint, time.monotonic() - started_at, error, remaining)
+
+    def _admit(self, session, args):
+        """
+        按预估的token数预约每分钟token额度，额度不足时排队等待
+        :return: 预约的token数，未开启时为0，等待过久被拒绝时为None
+        """
+        if not self.admission:
+            return 0
+        tokens = self.admission.estimate(session, args.get("max_tokens"))
+        return tokens if self.admission.admit(tokens) else None
+
+    async def _aadmit(self, session, args):
+        if not self.admission:
+            return 0
+        tokens = self.admission.estimate(session, args.get("max_tokens"))
+        return tokens if await self.admission.aadmit(tokens) else None
+
+    def _reconcile(self, reserved, used):
+        """
+        按实际用量调整预约的额度，请求失败时全部归还
+        """
+        if self.admission and reserved:
+            self.admission.reconcile(reserved, used)
+
+    async def _areconcile(self, reserved, used):
+        if self.admission and reserved:
+            await self.admission.areconcile(reserved, used)
+
+    @staticmethod
+    def _rejected_result() -> dict:
+        return {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+
+    @staticmethod
+    def _parse_response(response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_reply_error(self, e, session) -> dict:
+        """
+        记录错误日志，返回失败时回复给用户的结果，是否重试由retry_policy决定
+        """
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        kind = self.retry_policy.classify(e)
+        if kind == retry.RATE_LIMIT:
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+        elif kind == retry.TIMEOUT:
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+        elif kind == retry.SERVER:
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+        elif kind == retry.CONNECTION:
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            self.sessions.clear_session(session.session_id)
+        return result
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None):
+        """
+        call openai's ChatCompletion in stream mode, yield the answer piece by piece
+        the whole answer is saved to the session after the stream is finished
+        :param session: a conversation session
+        :return: generator of str
+        """
+        contents = []
+        if args is None:
+            args = self.args
+        # 流式响应不返回用量，预约的额度按预估值扣除，不再调整
+        reserved = self._admit(session, args)
+        if reserved is None:
+            yield self._rejected_result()["content"]
+            return
+        endpoint, started_at = None, None
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            if not self._acquire_token(session):
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            endpoint, request_args = self._request_args(api_key, args)
+            started_at = time.monotonic()
+            response = openai.ChatCompletion.create(messages=session.messages, stream=True, **request_args)
+            # 流式请求只统计到开始返回的耗时，读取过程中的错误不计入节点
+            self._release_endpoint(endpoint, started_at)
+            endpoint = None
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0]["delta"].get("content")
+                if content:
+                    contents.append(content)
+                    yield content
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+            logger.warn("[CHATGPT] stream Exception: {}".format(e))
+            self._release_endpoint(endpoint, started_at, e)
+            if not contents:
+                self._reconcile(reserved, 0)
+                if isinstance(e, openai.error.RateLimitError):
+                    yield "提问太快啦，请休息一下再问我吧"
+                else:
+                    yield "我现在有点累了，等会再来吧"
+            return
+        if contents:
+            self.sessions.session_reply("".join(contents), session.session_id)
 
 
 class AzureChatGPTBot(ChatGPTBot):
@@ -1,3 +1,5 @@
+import threading
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -16,12 +18,15 @@ class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        # 缓存每条消息的token数，id(message) -> (message, content, tokens)，避免每次裁剪都重新编码全部历史
+        self._message_tokens = {}
         self.reset()
 
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
-            cur_tokens = self.calc_tokens()
+            tokens = self.messages_tokens()
+            cur_tokens = sum(tokens) + reply_priming_tokens(self.model)
         except Exception as e:
             precise = False
             if cur_tokens is None:
@@ -33,7 +38,7 @@ class ChatGPTSession(Session):
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
                 self.messages.pop(1)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens = cur_tokens - tokens.pop(1)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -44,33 +49,132 @@ class ChatGPTSession(Session):
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens = cur_tokens - tokens.pop(1)
             else:
                 cur_tokens = cur_tokens - max_tokens
+        self._prune_message_tokens()
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        tokens = sum(self.messages_tokens()) + reply_priming_tokens(self.model)
+        self._prune_message_tokens()
+        return tokens
+
+    def messages_tokens(self) -> list:
+        """
+        获取每条消息的token数，已计算过且内容未变化的消息直接使用缓存，其余消息批量计算
+        """
+        missing = [message for message in self.messages if not self._is_cached(message)]
+        if missing:
+            for message, tokens in zip(missing, num_tokens_from_message_list(missing, self.model)):
+                self._message_tokens[id(message)] = (message, message.get("content"), tokens)
+        return [self._message_tokens[id(message)][2] for message in self.messages]
+
+    def _is_cached(self, message) -> bool:
+        cached = self._message_tokens.get(id(message))
+        return cached is not None and cached[0] is message and cached[1] is message.get("content")
+
+    def _prune_message_tokens(self):
+        if len(self._message_tokens) > len(self.messages):
+            alive = {id(message) for message in self.messages}
+            self._message_tokens = {k: v for k, v in self._message_tokens.items() if k in alive}
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    return sum(num_tokens_from_message_list(messages, model)) + reply_priming_tokens(model)
 
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
 
-    import tiktoken
+def reply_priming_tokens(model):
+    """Returns the number of tokens every reply is primed with."""
+    if get_token_counter(model) is None:
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming tokens."""
+    return num_tokens_from_message_list([message], model)[0]
+
 
+def num_tokens_from_message_list(messages, model):
+    """Returns the number of tokens used by each message, large message lists are encoded in one batch."""
+    counter = get_token_counter(model)
+    if counter is None:
+        return [num_tokens_by_character([message]) for message in messages]
+    encoding, tokens_per_message, tokens_per_name = counter
+    values = [value for message in messages for value in message.values()]
+    # encode_batch 每次调用都会新建并关闭一个线程池，只有值足够多时才划算
+    if len(values) >= ENCODE_BATCH_THRESHOLD:
+        encoded = encoding.encode_batch(values)
+    else:
+        encoded = [encoding.encode(value) for value in values]
+    result = []
+    index = 0
+    for message in messages:
+        num_tokens = tokens_per_message
+        for key in message:
+            num_tokens += len(encoded[index])
+            index += 1
+            if key == "name":
+                num_tokens += tokens_per_name
+        result.append(num_tokens)
+    return result
+
+
+_token_counters = {}  # model -> (encoding, tokens_per_message, tokens_per_name)，按字符计数的模型为None
+_token_counters_lock = threading.Lock()
+ENCODE_BATCH_THRESHOLD = 256  # 待编码的值达到该数量才使用encode_batch
+
+
+def get_token_counter(model):
+    """
+    获取模型对应的token计数参数，模型名称解析和tiktoken编码器加载只在首次调用时进行
+    :return: (encoding, tokens_per_message, tokens_per_name)，按字符计数的模型返回None
+    """
+    try:
+        return _token_counters[model]
+    except KeyError:
+        pass
+    with _token_counters_lock:
+        if model not in _token_counters:
+            _token_counters[model] = _load_token_counter(model)
+        return _token_counters[model]
+
+
+def preload_token_counter(model):
+    """Load the tokenizer of the model in advance, so the first query does not pay for it."""
+    try:
+        get_token_counter(model)
+    except Exception as e:
+        logger.warning("[ChatGPTSession] preload tokenizer for model {} failed: {}".format(model, e))
+
+
+def _resolve_model(model):
+    """Map the model name to the model whose token counting rules are used."""
     if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return "gpt-3.5-turbo"
     elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
                    "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
                    "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
                    const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
+        return "gpt-4"
     elif model.startswith("claude-3") or model.startswith("deepseek"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return "gpt-3.5-turbo"
+    elif model in ["gpt-3.5-turbo", "gpt-4"]:
+        return model
+    logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
+
+
+def _load_token_counter(model):
+    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
+        return None
+
+    import tiktoken
+
+    model = _resolve_model(model)
     try:
         encoding = tiktoken.encoding_for_model(model)
     except KeyError:
@@ -79,21 +183,10 @@ def num_tokens_from_messages(messages, model):
     if model == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
+    else:
         tokens_per_message = 3
         tokens_per_name = 1
-    else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return encoding, tokens_per_message, tokens_per_name
 
 
 def num_tokens_by_character(messages):
@@ -9,6 +9,7 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
 from config import conf
 
@@ -17,6 +18,8 @@ class ClaudeAIBot(Bot, OpenAIImage):
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ClaudeAiSession, model=conf().get("model") or "gpt-3.5-turbo")
+        # 请求失败的异常都视为服务端错误重试，与之前的行为一致
+        self.retry_policy = retry.RetryPolicy(classify=lambda e: retry.classify_error(e) or retry.SERVER)
         self.claude_api_cookie = conf().get("claude_api_cookie")
         self.proxy = conf().get("proxy")
         self.con_uuid_dic = {}
@@ -118,18 +121,17 @@ class ClaudeAIBot(Bot, OpenAIImage):
         # Returns JSON of the newly created conversation information
         return response.json()
         
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context, retry_count=0, retry_state=None) -> Reply:
         """
         发起对话请求
         :param query: 请求提示词
         :param context: 对话上下文
         :param retry_count: 当前递归重试次数
+        :param retry_state: 重试状态，由第一次请求创建
         :return: 回复
         """
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[CLAUDEAI] failed after maximum number of retry times")
-            return Reply(ReplyType.ERROR, "请再问我一次吧")
+        if retry_state is None:
+            retry_state = self.retry_policy.start(retry_count)
 
         try:
             session_id = context["session_id"]
@@ -209,14 +211,19 @@ class ClaudeAIBot(Bot, OpenAIImage):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    return self._retry_chat(query, context, retry_count, retry_state, kind=retry.SERVER, retry_after=retry.parse_retry_after(res.headers))
                 return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
 
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[CLAUDE] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return self._retry_chat(query, context, retry_count, retry_state, error=e)
+
+    def _retry_chat(self, query, context, retry_count, retry_state, error=None, kind=None, retry_after=None) -> Reply:
+        retry_delay = retry_state.next_delay(error, kind, retry_after)
+        if retry_delay is None:
+            logger.warn("[CLAUDEAI] failed after maximum number of retry times")
+            return Reply(ReplyType.ERROR, "请再问我一次吧")
+        logger.warn(f"[CLAUDE] do retry, times={retry_state.attempts}, delay={retry_delay:.1f}s")
+        time.sleep(retry_delay)
+        return self._chat(query, context, retry_count + 1, retry_state)
@@ -13,7 +13,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common import const, retry
 from config import conf
 
 user_session = dict()
@@ -31,6 +31,7 @@ class ClaudeAPIBot(Bot, OpenAIImage):
             base_url=base_url if base_url else None
         )
         self.sessions = SessionManager(BaiduWenxinSession, model=conf().get("model") or "text-davinci-003")
+        self.retry_policy = retry.RetryPolicy()
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -74,51 +75,50 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                 return reply
 
     def reply_text(self, session: BaiduWenxinSession, retry_count=0):
-        try:
-            actual_model = self._model_mapping(conf().get("model"))
-            response = self.claudeClient.messages.create(
-                model=actual_model,
-                max_tokens=4096,
-                system=conf().get("character_desc", ""),
-                messages=session.messages
-            )
-            # response = openai.Completion.create(prompt=str(session), **self.args)
-            res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
-            total_tokens = response.usage.input_tokens+response.usage.output_tokens
-            completion_tokens = response.usage.output_tokens
-            logger.info("[CLAUDE_API] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CLAUDE_API] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.warn("[CLAUDE_API] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                actual_model = self._model_mapping(conf().get("model"))
+                response = self.claudeClient.messages.create(
+                    model=actual_model,
+                    max_tokens=4096,
+                    system=conf().get("character_desc", ""),
+                    messages=session.messages
+                )
+                # response = openai.Completion.create(prompt=str(session), **self.args)
+                res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
+                total_tokens = response.usage.input_tokens+response.usage.output_tokens
+                completion_tokens = response.usage.output_tokens
+                logger.info("[CLAUDE_API] reply={}".format(res_content))
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": res_content,
+                }
+            except Exception as e:
+                result = {"total_tokens": 0, "completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                kind = self.retry_policy.classify(e)
+                if kind == retry.RATE_LIMIT:
+                    logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                elif kind == retry.TIMEOUT:
+                    logger.warn("[CLAUDE_API] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                elif kind == retry.SERVER:
+                    logger.warn("[CLAUDE_API] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                elif kind == retry.CONNECTION:
+                    logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                else:
+                    logger.warn("[CLAUDE_API] Exception: {}".format(e))
+                    self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[CLAUDE_API] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                time.sleep(retry_delay)
 
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
@@ -13,7 +13,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf, pconf
 import threading
-from common import memory, utils
+from common import memory, retry, utils
 import base64
 import os
 
@@ -26,6 +26,8 @@ class LinkAIBot(Bot):
         super().__init__()
         self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
+        # 请求异常时均重试，未识别的异常按服务端错误处理
+        self.retry_policy = retry.RetryPolicy(classify=lambda e: retry.classify_error(e) or retry.SERVER)
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
@@ -44,18 +46,17 @@ class LinkAIBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0) -> Reply:
+    def _chat(self, query, context, retry_count=0, retry_state=None) -> Reply:
         """
         发起对话请求
         :param query: 请求提示词
         :param context: 对话上下文
         :param retry_count: 当前递归重试次数
+        :param retry_state: 重试状态，由第一次请求创建
         :return: 回复
         """
-        if retry_count > 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.TEXT, "请再问我一次吧")
+        if retry_state is None:
+            retry_state = self.retry_policy.start(retry_count)
 
         try:
             # load config
@@ -160,9 +161,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    return self._retry_chat(query, context, retry_count, retry_state, kind=retry.SERVER, retry_after=retry.parse_retry_after(res.headers))
 
                 error_reply = "提问太快啦，请休息一下再问我吧"
                 if res.status_code == 409:
@@ -172,9 +171,16 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return self._retry_chat(query, context, retry_count, retry_state, error=e)
+
+    def _retry_chat(self, query, context, retry_count, retry_state, error=None, kind=None, retry_after=None) -> Reply:
+        retry_delay = retry_state.next_delay(error, kind, retry_after)
+        if retry_delay is None:
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
+        logger.warn(f"[LINKAI] do retry, times={retry_state.attempts}, delay={retry_delay:.1f}s")
+        time.sleep(retry_delay)
+        return self._chat(query, context, retry_count + 1, retry_state)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -236,15 +242,9 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
 
-    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return {
-                "total_tokens": 0,
-                "completion_tokens": 0,
-                "content": "请再问我一次吧"
-            }
+    def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0, retry_state=None) -> dict:
+        if retry_state is None:
+            retry_state = self.retry_policy.start(retry_count)
 
         try:
             body = {
@@ -284,9 +284,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    return self._retry_reply_text(session, app_code, retry_count, retry_state, kind=retry.SERVER, retry_after=retry.parse_retry_after(res.headers))
 
                 return {
                     "total_tokens": 0,
@@ -297,9 +295,20 @@ class LinkAIBot(Bot):
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            return self._retry_reply_text(session, app_code, retry_count, retry_state, error=e)
+
+    def _retry_reply_text(self, session, app_code, retry_count, retry_state, error=None, kind=None, retry_after=None) -> dict:
+        retry_delay = retry_state.next_delay(error, kind, retry_after)
+        if retry_delay is None:
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return {
+                "total_tokens": 0,
+                "completion_tokens": 0,
+                "content": "请再问我一次吧"
+            }
+        logger.warn(f"[LINKAI] do retry, times={retry_state.attempts}, delay={retry_delay:.1f}s")
+        time.sleep(retry_delay)
+        return self.reply_text(session, app_code, retry_count + 1, retry_state)
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
@@ -455,6 +464,7 @@ class LinkAISessionManager(SessionManager):
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self._save_session(session)
         return session
 
 
@@ -13,7 +13,7 @@ from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 import requests
-from common import const
+from common import const, retry
 
 
 # ZhipuAI对话模型API
@@ -42,6 +42,8 @@ class MinimaxBot(Bot):
             ],
         }
         self.sessions = SessionManager(MinimaxSession, model=const.MiniMax)
+        # 请求失败的异常都视为服务端错误重试，与之前的行为一致
+        self.retry_policy = retry.RetryPolicy(classify=lambda e: retry.classify_error(e) or retry.SERVER)
 
     def reply(self, query, context: Context = None) -> Reply:
         # acquire reply content
@@ -102,50 +104,40 @@ class MinimaxBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
-        try:
-            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
-            self.request_body["messages"].extend(session.messages)
-            logger.info("[Minimax_AI] request_body={}".format(self.request_body))
-            # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
+                self.request_body["messages"].extend(session.messages)
+                logger.info("[Minimax_AI] request_body={}".format(self.request_body))
+                # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                res = requests.post(self.base_url, headers=headers, json=self.request_body)
 
-            # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["total_tokens"],
-                    "content": response["reply"],
-                }
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
+                if res.status_code == 200:
+                    response = res.json()
+                    return {
+                        "total_tokens": response["usage"]["total_tokens"],
+                        "completion_tokens": response["usage"]["total_tokens"],
+                        "content": response["reply"],
+                    }
                 else:
-                    need_retry = False
+                    response = res.json()
+                    error = response.get("error")
+                    logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
+                    result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                    if res.status_code == 401:
+                        result["content"] = "授权失败，请检查API Key是否正确"
+                    elif res.status_code == 429:
+                        result["content"] = "请求过于频繁，请稍后再试"
+                    # 5xx和429按退避策略重试，优先使用服务端返回的Retry-After
+                    retry_delay = retry_state.next_delay(kind=retry.classify_status(res.status_code), retry_after=retry.parse_retry_after(res.headers))
+            except Exception as e:
+                logger.exception(e)
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                retry_delay = retry_state.next_delay(e)
+            if retry_delay is None:
                 return result
+            logger.warn(f"[Minimax_AI] do retry, times={retry_state.attempts}, delay={retry_delay:.1f}s")
+            time.sleep(retry_delay)
@@ -8,6 +8,7 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
@@ -19,6 +20,8 @@ class MoonshotBot(Bot):
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(MoonshotSession, model=conf().get("model") or "moonshot-v1-128k")
+        # 请求失败的异常都视为服务端错误重试，与之前的行为一致
+        self.retry_policy = retry.RetryPolicy(classify=lambda e: retry.classify_error(e) or retry.SERVER)
         model = conf().get("model") or "moonshot-v1-128k"
         if model == "moonshot":
             model = "moonshot-v1-32k"
@@ -90,57 +93,47 @@ class MoonshotBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
-        try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            body = args
-            body["messages"] = session.messages
-            # logger.debug("[MOONSHOT_AI] response={}".format(response))
-            # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
-                self.base_url,
-                headers=headers,
-                json=body
-            )
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                headers = {
+                    "Content-Type": "application/json",
+                    "Authorization": "Bearer " + self.api_key
                 }
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                body = args
+                body["messages"] = session.messages
+                # logger.debug("[MOONSHOT_AI] response={}".format(response))
+                # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+                res = requests.post(
+                    self.base_url,
+                    headers=headers,
+                    json=body
+                )
+                if res.status_code == 200:
+                    response = res.json()
+                    return {
+                        "total_tokens": response["usage"]["total_tokens"],
+                        "completion_tokens": response["usage"]["completion_tokens"],
+                        "content": response["choices"][0]["message"]["content"]
+                    }
                 else:
-                    need_retry = False
+                    response = res.json()
+                    error = response.get("error")
+                    logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
+                                 f"msg={error.get('message')}, type={error.get('type')}")
 
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
-        except Exception as e:
-            logger.exception(e)
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
-                return self.reply_text(session, args, retry_count + 1)
-            else:
+                    result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+                    if res.status_code == 401:
+                        result["content"] = "授权失败，请检查API Key是否正确"
+                    elif res.status_code == 429:
+                        result["content"] = "请求过于频繁，请稍后再试"
+                    # 5xx和429按退避策略重试，优先使用服务端返回的Retry-After
+                    retry_delay = retry_state.next_delay(kind=retry.classify_status(res.status_code), retry_after=retry.parse_retry_after(res.headers))
+            except Exception as e:
+                logger.exception(e)
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                retry_delay = retry_state.next_delay(e)
+            if retry_delay is None:
                 return result
+            logger.warn(f"[MOONSHOT_AI] do retry, times={retry_state.attempts}, delay={retry_delay:.1f}s")
+            time.sleep(retry_delay)
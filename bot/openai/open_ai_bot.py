@@ -10,6 +10,7 @@ from bot.openai.open_ai_session import OpenAISession
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
 from common.log import logger
 from config import conf
 
@@ -28,6 +29,7 @@ class OpenAIBot(Bot, OpenAIImage):
             openai.proxy = proxy
 
         self.sessions = SessionManager(OpenAISession, model=conf().get("model") or "text-davinci-003")
+        self.retry_policy = retry.RetryPolicy()
         self.args = {
             "model": conf().get("model") or "text-davinci-003",  # 对话模型的名称
             "temperature": conf().get("temperature", 0.9),  # 值在[0,1]之间，越大表示回复越具有不确定性
@@ -81,41 +83,40 @@ class OpenAIBot(Bot, OpenAIImage):
                 return reply
 
     def reply_text(self, session: OpenAISession, retry_count=0):
-        try:
-            response = openai.Completion.create(prompt=str(session), **self.args)
-            res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
-            total_tokens = response["usage"]["total_tokens"]
-            completion_tokens = response["usage"]["completion_tokens"]
-            logger.info("[OPEN_AI] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[OPEN_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
-            else:
-                logger.warn("[OPEN_AI] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                response = openai.Completion.create(prompt=str(session), **self.args)
+                res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
+                total_tokens = response["usage"]["total_tokens"]
+                completion_tokens = response["usage"]["completion_tokens"]
+                logger.info("[OPEN_AI] reply={}".format(res_content))
+                return {
+                    "total_tokens": total_tokens,
+                    "completion_tokens": completion_tokens,
+                    "content": res_content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                kind = self.retry_policy.classify(e)
+                if kind == retry.RATE_LIMIT:
+                    logger.warn("[OPEN_AI] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                elif kind == retry.TIMEOUT:
+                    logger.warn("[OPEN_AI] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                elif kind == retry.SERVER:
+                    logger.warn("[OPEN_AI] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                elif kind == retry.CONNECTION:
+                    logger.warn("[OPEN_AI] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                else:
+                    logger.warn("[OPEN_AI] Exception: {}".format(e))
+                    self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[OPEN_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
-            else:
-                return result
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[OPEN_AI] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                time.sleep(retry_delay)
@@ -4,7 +4,7 @@ import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.token_bucket import create_token_bucket
 from config import conf
 
 
@@ -12,12 +12,13 @@ from config import conf
 class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
+        self.tb4dalle = None
         if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+            self.tb4dalle = create_token_bucket("dalle", conf().get("rate_limit_dalle", 50))
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
+            if self.tb4dalle and not self.tb4dalle.get_token():
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[OPEN_AI] image_query={}".format(query))
             response = openai.Image.create(
@@ -1,5 +1,8 @@
+import threading
+
 from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.state_backend import get_state_backend
 from config import conf
 
 
@@ -38,13 +41,22 @@ class Session(object):
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        self.backend = get_state_backend()
+        # 未配置过期时间时会话不过期，同样按最近访问顺序保存，超出会话数或内存预算时淘汰最久未访问的会话
+        expires_in_seconds = conf().get("expires_in_seconds")
+        self.sessions = ExpiredDict(
+            expires_in_seconds or float("inf"),
+            max_size=conf().get("max_sessions") or None,
+            on_evict=self._on_session_evict,
+            sweep_interval=60 if expires_in_seconds else None,
+        )
         self.sessioncls = sessioncls
         self.session_args = session_args
+        # 会话持久化后，内存中的会话可以随时淘汰，按内存预算保留最近活跃的会话
+        self.memory_budget = conf().get("session_memory_budget", 0) if self.backend.shared else 0
+        self.session_bytes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -56,11 +68,91 @@ class SessionManager(object):
 
         if session_id not in self.sessions:
             self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            if system_prompt is None:
+                self._sync_session(self.sessions[session_id])
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+        else:
+            self._sync_session(self.sessions[session_id])
         session = self.sessions[session_id]
+        if system_prompt is not None:
+            self._save_session(session, replace=True)
         return session
 
+    def _sync_session(self, session):
+        """
+        从存储中加载会话，首次访问或其他进程更新了会话(版本号变化)时重新读取
+        """
+        if not self.backend.shared:
+            return
+        version = self.backend.session_version(session.session_id)
+        if version is None or version == getattr(session, "state_version", None):
+            return
+        loaded = self.backend.load_session(session.session_id)
+        if loaded is None:
+            return
+        messages, seqs, version = loaded
+        session.messages = messages
+        session.state_version = version
+        session.stored_messages = {id(message): (message, message.get("content"), seq) for message, seq in zip(messages, seqs)}
+
+    def _save_session(self, session, replace=False):
+        """
+        增量保存会话，只删除已被裁剪的消息并追加新消息
+        :param replace: 会话被重置时为True，覆盖存储中的全部消息
+        """
+        if not self.backend.shared:
+            return
+        stored = {} if replace else getattr(session, "stored_messages", {})
+        # 没有已保存的消息时写入的就是全部消息
+        replace = replace or not stored
+        kept = {}
+        new_messages = []
+        for message in session.messages:
+            record = stored.get(id(message))
+            if not new_messages and record is not None and record[0] is message and record[1] is message.get("content"):
+                kept[id(message)] = record
+            else:
+                new_messages.append(message)
+        deleted_seqs = [record[2] for key, record in stored.items() if key not in kept]
+        if not deleted_seqs and not new_messages and not replace:
+            return
+        result = self.backend.update_session(session.session_id, deleted_seqs, new_messages, replace)
+        if result is None:
+            # 存储中的会话已过期或被删除，用内存中的全部消息重新写入
+            kept = {}
+            new_messages = list(session.messages)
+            result = self.backend.update_session(session.session_id, [], new_messages, True)
+        seqs, session.state_version = result
+        kept.update({id(message): (message, message.get("content"), seq) for message, seq in zip(new_messages, seqs)})
+        session.stored_messages = kept
+        self._account_memory(session)
+
+    def _account_memory(self, session):
+        if not self.memory_budget:
+            return
+        size = sum(len(str(message.get("content", ""))) for message in session.messages)
+        with self.lock:
+            self.total_bytes += size - self.session_bytes.get(session.session_id, 0)
+            self.session_bytes[session.session_id] = size
+            if self.total_bytes <= self.memory_budget:
+                return
+        # 超出预算时从最久未访问的会话开始淘汰，降到预算的90%以下，避免频繁淘汰
+        # 淘汰时不持有self.lock，ExpiredDict的淘汰回调也会获取self.lock，避免死锁
+        for session_id in list(self.sessions.keys()):
+            if self.total_bytes <= self.memory_budget * 0.9:
+                break
+            if session_id != session.session_id:
+                self.sessions.pop(session_id, None)
+                with self.lock:
+                    self.total_bytes -= self.session_bytes.pop(session_id, 0)
+        logger.debug("[SessionManager] session memory={}, sessions={}".format(self.total_bytes, len(self.session_bytes)))
+
+    def _on_session_evict(self, session_id, session):
+        if self.memory_budget:
+            with self.lock:
+                self.total_bytes -= self.session_bytes.pop(session_id, 0)
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
@@ -70,6 +162,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self._save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +174,19 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self._save_session(session)
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        with self.lock:
+            self.total_bytes -= self.session_bytes.pop(session_id, 0)
+        self.backend.delete_session(session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        with self.lock:
+            self.session_bytes.clear()
+            self.total_bytes = 0
+        self.backend.clear_sessions()
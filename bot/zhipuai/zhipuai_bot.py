@@ -10,7 +10,10 @@ from bot.zhipuai.zhipu_ai_session import ZhipuAISession
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import retry
+from common.image_cache import ImageCache
 from common.log import logger
+from common.token_bucket import create_token_bucket
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
@@ -26,6 +29,10 @@ class ZHIPUAIBot(Bot, IImageCreate):
             "top_p": conf().get("top_p", 0.7),  # 值在(0,1)之间(智谱AI 的 top_p 不能取 0 或者 1)
         }
         self.client = ZhipuAI(api_key=conf().get("zhipu_ai_api_key"))
+        self.retry_policy = retry.RetryPolicy()
+        self.tb4dalle = None
+        if conf().get("rate_limit_dalle"):
+            self.tb4dalle = create_token_bucket("zhipu_image", conf().get("rate_limit_dalle", 50))
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -98,59 +105,52 @@ class ZHIPUAIBot(Bot, IImageCreate):
         :param retry_count: retry count
         :return: {}
         """
-        try:
-            # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-            #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
-            if args is None:
-                args = self.args
-            # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            response = self.client.chat.completions.create(messages=session.messages, **args)
-            # logger.debug("[ZHIPU_AI] response={}".format(response))
-            # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-
-            return {
-                "total_tokens": response.usage.total_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "content": response.choices[0].message.content,
-            }
-        except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
-            else:
-                logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
-
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
-            else:
-                return result
+        retry_state = self.retry_policy.start(retry_count)
+        while True:
+            try:
+                # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+                #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+                # if api_key == None, the default openai.api_key will be used
+                if args is None:
+                    args = self.args
+                # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
+                response = self.client.chat.completions.create(messages=session.messages, **args)
+                # logger.debug("[ZHIPU_AI] response={}".format(response))
+                # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+
+                return {
+                    "total_tokens": response.usage.total_tokens,
+                    "completion_tokens": response.usage.completion_tokens,
+                    "content": response.choices[0].message.content,
+                }
+            except Exception as e:
+                result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+                kind = self.retry_policy.classify(e)
+                if kind == retry.RATE_LIMIT:
+                    logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
+                    result["content"] = "提问太快啦，请休息一下再问我吧"
+                elif kind == retry.TIMEOUT:
+                    logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
+                    result["content"] = "我没有收到你的消息"
+                elif kind == retry.SERVER:
+                    logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
+                    result["content"] = "请再问我一次"
+                elif kind == retry.CONNECTION:
+                    logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
+                    result["content"] = "我连接不到你的网络"
+                else:
+                    logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
+                    self.sessions.clear_session(session.session_id)
+
+                retry_delay = retry_state.next_delay(e)
+                if retry_delay is None:
+                    return result
+                logger.warn("[ZHIPU_AI] 第{}次重试, 等待{:.1f}秒".format(retry_state.attempts, retry_delay))
+                time.sleep(retry_delay)
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         try:
-            if conf().get("rate_limit_dalle"):
+            if self.tb4dalle and not self.tb4dalle.get_token():
                 return False, "请求太快了，请休息一下再问我吧"
             logger.info("[ZHIPU_AI] image_query={}".format(query))
             response = self.client.images.generations(
@@ -182,7 +182,15 @@ class ZHIPUAIBot(Bot, IImageCreate):
         :return: (是否成功, 描述结果)
         """
         model = conf().get("zhipu_ai_image_to_text_model")
+        desc_key = None
         try:
+            if conf().get("image_cache", True):
+                # 相同图片和提问直接使用缓存的识别结果
+                desc_key = ImageCache().description_key(images, model, text)
+                description = ImageCache().get_description(desc_key)
+                if description is not None:
+                    logger.debug("[ZHIPU_AI] explain_img hit cache")
+                    return True, description
             # 处理多张图片
             image_contents = []
             for imageFile in images:
@@ -217,7 +225,10 @@ class ZHIPUAIBot(Bot, IImageCreate):
                 model=model,
                 messages=messages
             )
-            return True, response.choices[0].message.content
+            description = response.choices[0].message.content
+            if desc_key:
+                ImageCache().put_description(desc_key, description)
+            return True, description
         except Exception as e:
             logger.exception(f"[ZHIPU_AI] explain_img error: {e}")
             return False, "图片描述失败，请稍后再试"
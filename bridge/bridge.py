@@ -89,6 +89,12 @@ class Bridge(object):
     def fetch_reply_content(self, query, context: Context) -> Reply:
         return self.get_bot("chat").reply(query, context)
 
+    async def afetch_reply_content(self, query, context: Context) -> Reply:
+        return await self.get_bot("chat").areply(query, context)
+
+    def has_async_reply(self) -> bool:
+        return self.get_bot("chat").has_async_reply()
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
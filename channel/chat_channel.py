@@ -1,15 +1,19 @@
+import asyncio
 import os
 import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future
+from queue import Queue
 
+from bridge.bridge import Bridge
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
 from common.dequeue import Dequeue
-from common import memory
+from common import async_loop, memory, worker_pool
+from common.state_backend import get_state_backend
 from plugins import *
 
 try:
@@ -17,7 +21,17 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+
+def get_handler_pool(context_type: ContextType) -> worker_pool.WorkerPool:
+    """
+    获取处理消息的线程池，handler_pool_by_context_type中配置了的消息类型使用独立线程池，
+    避免语音、图片等耗时任务占满线程导致文本消息无法处理，其余类型共用默认线程池
+    """
+    slow_wait_seconds = conf().get("handler_pool_slow_wait_seconds")
+    type_pools = conf().get("handler_pool_by_context_type") or {}
+    if context_type is not None and context_type.name in type_pools:
+        return worker_pool.get_pool(context_type.name.lower(), type_pools[context_type.name], slow_wait_seconds)
+    return worker_pool.get_pool("handler", conf().get("handler_pool_max_workers", 8), slow_wait_seconds)
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -27,6 +41,7 @@ class ChatChannel(Channel):
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
     lock = threading.Lock()  # 用于控制对sessions的访问
+    ready_sessions = Queue()  # 可能有待处理消息的session_id，produce和任务结束时放入，consume阻塞等待，避免轮询
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
@@ -166,26 +181,67 @@ class ChatChannel(Channel):
         if context is None or not context.content:
             return
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
-        # reply的构建步骤
-        reply = self._generate_reply(context)
+        # 多进程共享状态时，同一会话的消息在进程间也需要依次处理
+        with get_state_backend().session_lock(context.get("session_id")):
+            # reply的构建步骤
+            reply = self._generate_reply(context)
+
+            logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+
+            # reply的包装步骤
+            logger.debug("[chat_channel] ready to send reply: {}".format(reply))
+            if reply and reply.content:
+                reply = self._decorate_reply(context, reply)
 
-        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+                # reply的发送步骤
+                self._send_reply(context, reply)
 
-        # reply的包装步骤
-        logger.debug("[chat_channel] ready to send reply: {}".format(reply))
-        if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+    def _use_async_reply(self, context: Context) -> bool:
+        """
+        开启async_reply且bot原生支持异步时，文本消息在事件循环中等待模型回复，不占用处理线程
+        """
+        return conf().get("async_reply") and context.type == ContextType.TEXT and not context.get("stream") and Bridge().has_async_reply()
+
+    async def _ahandle(self, context: Context, cancel_event: threading.Event = None):
+        if cancel_event is not None and cancel_event.is_set():  # 开始执行前被cancel_session取消
+            return
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to handle context async: {}".format(context))
+        loop = asyncio.get_running_loop()
+        pool = get_handler_pool(context.type)
+        # 插件、装饰和发送仍是同步逻辑，放到线程池中执行，只有请求模型的过程在事件循环中等待
+        session_lock = get_state_backend().session_lock(context.get("session_id"))
+        # 加锁和解锁都等线程池中的调用结束，解锁完成后协程才结束，之后回调才释放信号量
+        if await _wait_uninterrupted(loop.run_in_executor(pool, session_lock.__enter__)):
+            await _wait_uninterrupted(loop.run_in_executor(pool, session_lock.__exit__, None, None, None))
+            raise asyncio.CancelledError()
+        try:
+            e_context = await loop.run_in_executor(pool, self._emit_handle_context, context, Reply())
+            if not e_context.is_pass() and context.type == ContextType.TEXT:
+                context["channel"] = e_context["channel"]
+                reply = await self.abuild_reply_content(context.content, context)
+            else:
+                reply = await loop.run_in_executor(pool, self._generate_reply, context, Reply(), e_context)
 
-            # reply的发送步骤
-            self._send_reply(context, reply)
+            logger.debug("[chat_channel] ready to send reply: {}".format(reply))
+            if reply and reply.content:
+                reply = await loop.run_in_executor(pool, self._decorate_reply, context, reply)
+                await loop.run_in_executor(pool, self._send_reply, context, reply)
+        finally:
+            await _wait_uninterrupted(loop.run_in_executor(pool, session_lock.__exit__, None, None, None))
 
-    def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
-        e_context = PluginManager().emit_event(
+    def _emit_handle_context(self, context: Context, reply: Reply) -> EventContext:
+        return PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
                 {"channel": self, "context": context, "reply": reply},
             )
         )
+
+    def _generate_reply(self, context: Context, reply: Reply = Reply(), e_context: EventContext = None) -> Reply:
+        if e_context is None:
+            e_context = self._emit_handle_context(context, reply)
         reply = e_context["reply"]
         if not e_context.is_pass():
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
@@ -276,6 +332,9 @@ class ChatChannel(Channel):
         return reply
 
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        if reply and reply.type == ReplyType.STREAM and (not context.get("stream") or context.get("desire_rtype") == ReplyType.VOICE):
+            # 通道未开启流式回复或需要语音回复时，等待全部内容生成后按文本回复处理
+            reply = Reply(ReplyType.TEXT, "".join(reply.content))
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -303,6 +362,16 @@ class ChatChannel(Channel):
                     else:
                         reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
                     reply.content = reply_text
+                elif reply.type == ReplyType.STREAM:
+                    if context.get("isgroup", False):
+                        prefix = conf().get("group_chat_reply_prefix", "")
+                        if not context.get("no_need_at", False):
+                            prefix += "@" + context["msg"].actual_user_nickname + "\n"
+                        suffix = conf().get("group_chat_reply_suffix", "")
+                    else:
+                        prefix = conf().get("single_chat_reply_prefix", "")
+                        suffix = conf().get("single_chat_reply_suffix", "")
+                    reply.content = _wrap_stream(reply.content, prefix, suffix)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -332,7 +401,7 @@ class ChatChannel(Channel):
             self.send(reply, context)
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
-            if isinstance(e, NotImplementedError):
+            if isinstance(e, NotImplementedError) or reply.type == ReplyType.STREAM:  # 流式内容已被消费，无法重试
                 return
             logger.exception(e)
             if retry_cnt < 2:
@@ -359,6 +428,7 @@ class ChatChannel(Channel):
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
                 self.sessions[session_id][1].release()
+            self.ready_sessions.put(session_id)  # 释放了信号量，唤醒消费者处理该session的下一条消息
 
         return func
 
@@ -374,40 +444,58 @@ class ChatChannel(Channel):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
             else:
                 self.sessions[session_id][0].put(context)
+        self.ready_sessions.put(session_id)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，阻塞等待就绪的session，每次唤醒只处理一个session，不再扫描全部session
     def consume(self):
         while True:
+            session_id = self.ready_sessions.get()
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
+                if session_id not in self.sessions:  # session已处理完毕并被删除
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+            if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
+                if not context_queue.empty():
+                    context = context_queue.get()
+                    logger.debug("[chat_channel] consume context: {}".format(context))
+                    if self._use_async_reply(context):
+                        cancel_event = threading.Event()
+                        future: Future = async_loop.submit(self._ahandle(context, cancel_event))
+                        future.cancel_event = cancel_event
                     else:
-                        semaphore.release()
-            time.sleep(0.2)
-
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+                        future: Future = get_handler_pool(context.type).submit(self._handle, context)
+                    future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+                    with self.lock:
+                        if session_id not in self.futures:
+                            self.futures[session_id] = []
+                        self.futures[session_id].append(future)
+                elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
+                    with self.lock:
+                        if not context_queue.empty():  # 期间有新消息进入，由produce放入的唤醒处理
+                            semaphore.release()
+                            continue
+                        futures = [t for t in self.futures.pop(session_id, []) if not t.done()]
+                        assert len(futures) == 0, "thread pool error"
+                        del self.sessions[session_id]
+                else:
+                    semaphore.release()
+            # 信号量已满时无需处理，正在执行的任务结束后会再次唤醒该session
+
+    @staticmethod
+    def _cancel_future(future: Future):
+        cancel_event = getattr(future, "cancel_event", None)
+        if cancel_event is not None:
+            # 协程的Future取消时会中断正在执行的协程，这里只标记，未开始的协程开始时直接返回
+            cancel_event.set()
+        else:
+            future.cancel()
+
+    # 取消session_id对应的所有任务，只能取消排队的消息和已提交但未开始执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
+                for future in self.futures.get(session_id, []):
+                    self._cancel_future(future)
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
@@ -416,14 +504,37 @@ class ChatChannel(Channel):
     def cancel_all_session(self):
         with self.lock:
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
+                for future in self.futures.get(session_id, []):
+                    self._cancel_future(future)
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
 
 
+async def _wait_uninterrupted(future) -> bool:
+    """
+    等待线程池中的调用结束，期间协程被取消也继续等待，避免加锁成功后没有解锁
+    :return: 等待期间是否被取消
+    """
+    cancelled = False
+    while not future.done():
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled = True
+    future.result()
+    return cancelled
+
+
+def _wrap_stream(stream, prefix="", suffix=""):
+    if prefix:
+        yield prefix
+    yield from stream
+    if suffix:
+        yield suffix
+
+
 def check_prefix(content, prefix_list):
     if not prefix_list:
         return None
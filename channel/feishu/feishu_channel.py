@@ -6,9 +6,10 @@
 """
 
 # -*- coding=utf-8 -*-
+import threading
+import time
 import uuid
 
-import requests
 import web
 from channel.channel import Channel
 from channel.feishu.feishu_message import FeishuMessage
@@ -17,14 +18,19 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.singleton import singleton
 from config import conf
-from common.expired_dict import ExpiredDict
+from common.dedup import DedupStore
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
-from common import utils
+from common import http_client, utils, worker_pool
 import json
 import os
 
 URL_VERIFICATION = "url_verification"
+# tenant_access_token有效期内剩余不足30分钟时，飞书会下发新token，提前25分钟开始后台刷新
+TOKEN_REFRESH_AHEAD_SECONDS = 25 * 60
+TOKEN_EXPIRE_MARGIN_SECONDS = 60
+# 刷新失败后的退避时间，从1秒开始翻倍
+TOKEN_RETRY_MAX_SECONDS = 60
 
 
 @singleton
@@ -36,7 +42,14 @@ class FeiShuChanel(ChatChannel):
     def __init__(self):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.receivedMsgs = DedupStore(60 * 60 * 7.1, "feishu")
+        # tenant_access_token缓存
+        self._access_token = None
+        self._access_token_expire_at = 0
+        self._access_token_lock = threading.Lock()
+        self._access_token_refreshing = False
+        self._access_token_retry_at = 0  # 刷新失败后，在此之前不再请求
+        self._access_token_backoff = 0
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -67,10 +80,9 @@ class FeiShuChanel(ChatChannel):
                 msg = event.get("message")
 
                 # 幂等判断
-                if self.receivedMsgs.get(msg.get("message_id")):
+                if self.receivedMsgs.seen(msg.get("message_id")):
                     logger.warning(f"[FeiShu] repeat msg filtered, event_id={header.get('event_id')}")
                     return '{"success": true}'
-                self.receivedMsgs[msg.get("message_id")] = True
 
                 is_group = False
                 chat_type = msg.get("chat_type")
@@ -89,42 +101,60 @@ class FeiShuChanel(ChatChannel):
                 else:
                     logger.warning("[FeiShu] message ignore")
                     return '{"success": true}'
-                
-                # 构造飞书消息对象
-                feishu_msg = FeishuMessage(event, is_group=is_group, access_token=self.fetch_access_token())
-                if not feishu_msg:
-                    return '{"success": true}'
 
-                context = self._compose_context_from_controller(
-                    feishu_msg.ctype,
-                    feishu_msg.content,
-                    isgroup=is_group,
-                    msg=feishu_msg,
-                    receive_id_type=receive_id_type,
-                    no_need_at=True
-                )
-                if context:
-                    self.produce(context)
-                logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+                # 消息对象构造(获取父消息、下载附件等)放到后台执行，尽快响应飞书回调，避免超时重推
+                hydrate_pool = self._get_hydrate_pool(event.get("sender").get("sender_id").get("open_id"))
+                hydrate_pool.submit(self._hydrate_message, event, is_group, receive_id_type)
             return '{"success": true}'
 
         except Exception as e:
             logger.error(e)
             return '{"success": false}'
 
+    def _get_hydrate_pool(self, sender_id):
+        """
+        按发送者分配后台线程池，每个线程池只有一个线程，保证同一用户的消息按接收顺序进入会话队列
+        """
+        workers = max(int(conf().get("feishu_hydrate_workers", 4)), 1)
+        index = hash(sender_id) % workers
+        return worker_pool.get_pool(f"feishu_hydrate_{index}", 1)
+
+    def _hydrate_message(self, event, is_group, receive_id_type):
+        try:
+            # 构造飞书消息对象
+            feishu_msg = FeishuMessage(event, is_group=is_group, access_token=self.fetch_access_token())
+            feishu_msg.fetch_parent_msg()
+
+            context = self._compose_context_from_controller(
+                feishu_msg.ctype,
+                feishu_msg.content,
+                isgroup=is_group,
+                msg=feishu_msg,
+                receive_id_type=receive_id_type,
+                no_need_at=True,
+                stream=conf().get("feishu_stream_reply", False)
+            )
+            if context:
+                self.produce(context)
+            logger.info(f"[FeiShu] query={feishu_msg.content}, type={feishu_msg.ctype}")
+        except NotImplementedError as e:
+            # 不支持的消息类型，只打印一行日志
+            logger.error(f"[FeiShu] unsupported message, message_id={event.get('message').get('message_id')}, {e}")
+        except Exception as e:
+            logger.exception(f"[FeiShu] handle message error, message_id={event.get('message').get('message_id')}, {e}")
+
     def send(self, reply: Reply, context: Context):
         logger.debug(f"[FeiShu] send message, reply={reply}, context={context}")
-        msg = context.get("msg")
-        is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
+        access_token = self.fetch_access_token()
         headers = {
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
         }
-        
+
+        if reply.type == ReplyType.STREAM:
+            self._send_stream(reply, context, headers)
+            return
+
         if reply.type == ReplyType.IMAGE_URL:
             # 处理图片消息
             image_key = self._upload_image_url(reply.content, access_token)
@@ -155,24 +185,112 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": "post",
                 "content": contentStr
             }
+        self._send_message(data, context, headers)
 
-        if is_group:
+    def _send_message(self, data: dict, context: Context, headers: dict):
+        """
+        发送消息，群聊中回复原消息，私聊中直接发送
+        :return: 发送成功时返回消息id
+        """
+        msg = context.get("msg")
+        if context["isgroup"]:
             # 群聊中直接回复
             url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
             data["receive_id"] = context.get("receiver")
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
 
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
+            return res.get("data", {}).get("message_id")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
 
+    def _send_stream(self, reply: Reply, context: Context, headers: dict):
+        """
+        流式回复，收到首段内容时发送消息卡片，之后按时间间隔更新卡片内容，结束时再更新一次完整内容
+        """
+        interval = conf().get("feishu_stream_update_interval", 1)
+        text = ""
+        message_id = None
+        last_update = 0
+        for chunk in reply.content:
+            text += chunk
+            if not text.strip():
+                continue
+            if message_id is None:
+                message_id = self._send_message({"msg_type": "interactive", "content": self._build_stream_card(text)}, context, headers)
+                if message_id is None:
+                    break
+                last_update = time.monotonic()
+            elif time.monotonic() - last_update >= interval:
+                self._update_card(message_id, text, headers)
+                last_update = time.monotonic()
+        if message_id:
+            self._update_card(message_id, text, headers)
+
+    def _update_card(self, message_id, text, headers):
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+        res = http_client.patch(url=url, headers=headers, json={"content": self._build_stream_card(text)}, timeout=(5, 10)).json()
+        if res.get("code") != 0:
+            logger.warning(f"[FeiShu] update stream card failed, code={res.get('code')}, msg={res.get('msg')}")
+
+    @staticmethod
+    def _build_stream_card(text) -> str:
+        card = {
+            "config": {"wide_screen_mode": True, "update_multi": True},
+            "elements": [{"tag": "markdown", "content": text}],
+        }
+        return json.dumps(card)
+
     def fetch_access_token(self) -> str:
+        """
+        获取tenant_access_token，优先使用缓存
+        临近过期时后台刷新，已过期时同步刷新，同一时间只有一个刷新请求，失败后退避重试
+        """
+        now = time.monotonic()
+        if self._access_token and now < self._access_token_expire_at:
+            if now > self._access_token_expire_at - TOKEN_REFRESH_AHEAD_SECONDS and now >= self._access_token_retry_at:
+                with self._access_token_lock:
+                    start_refresh = not self._access_token_refreshing
+                    self._access_token_refreshing = True
+                if start_refresh:
+                    threading.Thread(target=self._refresh_access_token, daemon=True).start()
+            return self._access_token
+        return self._refresh_access_token()
+
+    def _refresh_access_token(self) -> str:
+        with self._access_token_lock:
+            try:
+                # 等待锁期间其他线程可能已经完成刷新
+                now = time.monotonic()
+                if self._access_token and now < self._access_token_expire_at - TOKEN_REFRESH_AHEAD_SECONDS:
+                    return self._access_token
+                # 刚刷新失败时，等待锁的调用直接使用当前结果，不再逐个重复请求
+                if now < self._access_token_retry_at:
+                    return self._access_token if self._access_token and now < self._access_token_expire_at else ""
+                token, expire = self._request_access_token()
+                if token:
+                    self._access_token = token
+                    self._access_token_expire_at = time.monotonic() + expire - TOKEN_EXPIRE_MARGIN_SECONDS
+                    self._access_token_retry_at = 0
+                    self._access_token_backoff = 0
+                    logger.debug(f"[FeiShu] tenant_access_token refreshed, expire={expire}")
+                    return self._access_token
+                self._access_token_backoff = min(max(self._access_token_backoff * 2, 1), TOKEN_RETRY_MAX_SECONDS)
+                self._access_token_retry_at = time.monotonic() + self._access_token_backoff
+                logger.warning(f"[FeiShu] refresh tenant_access_token failed, retry after {self._access_token_backoff}s")
+                if not self._access_token or time.monotonic() >= self._access_token_expire_at:
+                    return ""
+                return self._access_token
+            finally:
+                self._access_token_refreshing = False
+
+    def _request_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -182,20 +300,25 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
+        try:
+            response = http_client.post(url=url, data=data, headers=headers, timeout=(5, 10))
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, {e}")
+            return None, 0
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
                 logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
+                return None, 0
             else:
-                return res.get("tenant_access_token")
+                return res.get("tenant_access_token"), res.get("expire", 0)
         else:
             logger.error(f"[FeiShu] fetch token error, res={response}")
+            return None, 0
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -212,7 +335,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
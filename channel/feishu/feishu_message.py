@@ -1,19 +1,57 @@
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 import json
-import requests
+import os
+import uuid
+from common import http_client, worker_pool
+from common.image_cache import ImageCache
 from common.log import logger
 from common.tmp_dir import TmpDir
 from common import utils
+from config import conf
 
 
-def _download_file_helper(url, headers, params, file_path):
-    response = requests.get(url=url, headers=headers, params=params)
-    if response.status_code == 200:
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-    else:
-        logger.info(f"[FeiShu] Failed to download file, url={url}, res={response.text}")
+def _download_file_helper(url, headers, params, file_path, cache_key=None):
+    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        logger.debug(f"[FeiShu] file already downloaded, file_path={file_path}")
+        return
+    if cache_key and conf().get("image_cache", True) and ImageCache().get_file(cache_key, file_path):
+        logger.debug(f"[FeiShu] file hit cache, key={cache_key}")
+        return
+    response = http_client.get(url=url, headers=headers, params=params, stream=True)
+    with response:
+        if response.status_code == 200:
+            # 先写入临时文件再重命名，避免并发下载时读到不完整的文件
+            tmp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+            try:
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            if cache_key and conf().get("image_cache", True):
+                ImageCache().put_file(cache_key, file_path)
+        else:
+            logger.info(f"[FeiShu] Failed to download file, url={url}, res={response.text}")
+
+
+def _download_files_helper(tasks):
+    """
+    并发下载多个文件，并发数由feishu_download_concurrency配置
+    :param tasks: [(url, headers, params, file_path, cache_key), ...]
+    """
+    if len(tasks) == 1:
+        _download_file_helper(*tasks[0])
+        return
+    pool = worker_pool.get_pool("feishu_download", conf().get("feishu_download_concurrency", 4))
+    futures = [pool.submit(_download_file_helper, *task) for task in tasks]
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"[FeiShu] download file error: {e}")
 
 
 class FeishuMessage(ChatMessage):
@@ -59,27 +97,30 @@ class FeishuMessage(ChatMessage):
                                                 "file_path": TmpDir().path() + image_key + ".png"
                                             }
                                             text_parts.append(f"![{image_key}]")
-                                            # 记录图片信息
-                                            self._image_keys = list(self.appendix.keys())
-
-                                            # 设置图片下载函数
-                                            def _download_image():
-                                                for image_key in self._image_keys:
-                                                    url = f"https://open.feishu.cn/open-apis/im/v1/messages/{self.msg_id}/resources/{image_key}"
-                                                    headers = {
-                                                        "Authorization": "Bearer " + self.access_token,
-                                                    }
-                                                    params = {
-                                                        "type": "image"
-                                                    }
-                                                    _download_file_helper(url, headers, params, self.appendix[image_key]["file_path"])
-                                            self._prepare_fn = _download_image
                         elif isinstance(content_item, dict):
                             if content_item.get("tag") == "text":
                                 text = content_item.get("text", "")
                                 if text:
                                     text_parts.append(text)
                 self.content = " ".join(text_parts).strip()
+                if self.appendix:
+                    # 记录图片信息
+                    self._image_keys = list(self.appendix.keys())
+
+                    # 设置图片下载函数，多张图片并发下载
+                    def _download_image():
+                        tasks = []
+                        for image_key in self._image_keys:
+                            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{self.msg_id}/resources/{image_key}"
+                            headers = {
+                                "Authorization": "Bearer " + self.access_token,
+                            }
+                            params = {
+                                "type": "image"
+                            }
+                            tasks.append((url, headers, params, self.appendix[image_key]["file_path"], image_key))
+                        _download_files_helper(tasks)
+                    self._prepare_fn = _download_image
                 logger.debug(f"[FeiShu] extracted post text: {self.content}")
                 logger.debug(f"[FeiShu] post message appendix: {self.appendix}")
             except Exception as e:
@@ -119,7 +160,7 @@ class FeishuMessage(ChatMessage):
                 params = {
                     "type": "image"
                 }
-                _download_file_helper(url, headers, params, self.content)
+                _download_file_helper(url, headers, params, self.content, image_key)
             self._prepare_fn = _download_image
         else:
             # Unsupported message type: Type:merge_forward
@@ -129,15 +170,29 @@ class FeishuMessage(ChatMessage):
         self.from_user_id = sender.get("sender_id").get("open_id")
         self.to_user_id = event.get("app_id")
 
-        # 获取父消息
         self.parent_msg = None
+        if is_group:
+            # 群聊
+            self.other_user_id = msg.get("chat_id")
+            self.actual_user_id = self.from_user_id
+            self.content = self.content.replace("@_user_1", "").strip()
+            self.actual_user_nickname = ""
+        else:
+            # 私聊
+            self.other_user_id = self.from_user_id
+            self.actual_user_id = self.from_user_id
+
+    def fetch_parent_msg(self):
+        """
+        获取父消息内容并下载其中的图片附件，涉及网络请求，在后台线程中调用
+        """
         if self.parent_id and self.access_token:
             url = f"https://open.feishu.cn/open-apis/im/v1/messages/{self.parent_id}"
             headers = {
                 "Authorization": f"Bearer {self.access_token}",
                 "Content-Type": "application/json"
             }
-            response = requests.get(url, headers=headers)
+            response = http_client.get(url, headers=headers)
             if response.status_code == 200:
                 items = response.json().get("data", {}).get("items", [])
                 first_item = items[0]
@@ -159,6 +214,7 @@ class FeishuMessage(ChatMessage):
                     self.parent_msg["text"] = res.get("text")
                     self.parent_msg["appendix"] = res.get("appendix")
                 # 下载附件(图片)
+                tasks = []
                 for appendix in self.parent_msg.get("appendix", []):
                     if appendix.get("type") == "image":
                         url = f"https://open.feishu.cn/open-apis/im/v1/messages/{appendix.get('message_id')}/resources/{appendix.get('key')}"
@@ -170,18 +226,10 @@ class FeishuMessage(ChatMessage):
                         }
                         # https://open.feishu.cn/document/server-docs/im-v1/message/get-2?appId=cli_a5cac8e139f8d00d
                         # 暂不支持获取合并转发消息中的子消息、卡片消息中的资源文件。
-                        _download_file_helper(url, headers, params, appendix.get("file_path"))
-        if is_group:
-            # 群聊
-            self.other_user_id = msg.get("chat_id")
-            self.actual_user_id = self.from_user_id
-            self.content = self.content.replace("@_user_1", "").strip()
-            self.actual_user_nickname = ""
-        else:
-            # 私聊
-            self.other_user_id = self.from_user_id
-            self.actual_user_id = self.from_user_id
-    
+                        tasks.append((url, headers, params, appendix.get("file_path"), appendix.get("key")))
+                if tasks:
+                    _download_files_helper(tasks)
+
     # {'body': {'content': '{"image_key":"img_v3_02ip_beb56cd0-52a8-4d34-9388-6f0026523e6g"}'}, 'chat_id': 'oc_1db2c6250ca2935b9d68ab9261c63b60', 'create_time': '1737524321810', 'deleted': False, 'message_id': 'om_069dadebd6947fcdeb623dfaa0f55567', 'msg_type': 'image', 'sender': {'id': 'ou_d441fdf71e0abffc3936eb420e7b979f', 'id_type': 'open_id', 'sender_type': 'user', 'tenant_key': '2e524b52fecf165f'}, 'update_time': '1737524321810', 'updated': False}
     # returns {'text': '![img_v3_02ip_beb56cd0-52a8-4d34-9388-6f0026523e6g]', 'appendix': [{'type': 'image', 'key': 'img_v3_02ip_beb56cd0-52a8-4d34-9388-6f0026523e6g', 'message_id': 'om_069dadebd6947fcdeb623dfaa0f55567', 'file_path': '/tmp/img_v3_02ip_beb56cd0-52a8-4d34-9388-6f0026523e6g.png'}]}
     def resolve_msg(self, msg_item) -> dict:
@@ -15,7 +15,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.singleton import singleton
 from config import conf
-from common.expired_dict import ExpiredDict
+from common.dedup import DedupStore
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
 
@@ -25,7 +25,7 @@ class GitlabChannel(ChatChannel):
     def __init__(self):
         super().__init__()
         # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.receivedMsgs = DedupStore(60 * 60 * 7.1, "gitlab")
         logger.info("[Gitlab] channel initialized")
 
     def handle_request(self, req):
@@ -40,10 +40,9 @@ class GitlabChannel(ChatChannel):
 
             # 2. 消息接收处理
             # 幂等判断
-            if self.receivedMsgs.get(request.get("object_attributes", {}).get("id")):
+            if self.receivedMsgs.seen(request.get("object_attributes", {}).get("id")):
                 logger.warning(f"[Gitlab] repeat msg filtered, event_id={request.get('object_attributes', {}).get('id')}")
                 return '{"success": true}'
-            self.receivedMsgs[request.get("object_attributes", {}).get("id")] = True
 
             # 构造 GitLab 消息对象
             gitlab_msg = GitlabMessage(request)
@@ -0,0 +1,91 @@
+"""
+按token数的准入控制
+模型服务商按每分钟token数限流，请求前按会话内容估算本次消耗的token并预约额度，额度不足时排队等待，
+等待时间过长则直接拒绝，不再把请求发给服务商换来429；请求完成后按实际用量多退少补
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+from common.log import logger
+from common.token_bucket import create_token_bucket
+
+
+class TokenAdmission(object):
+    """
+    :param name: 名称，多进程共享状态时同名的额度在所有进程间共享
+    :param tokens_per_minute: 每分钟token数上限
+    :param max_wait: 排队等待额度的最长秒数，超过则拒绝请求
+    :param completion_tokens: 回复token数的预估值，请求前无法得知回复长度，先按该值预约
+    """
+
+    def __init__(self, name, tokens_per_minute, max_wait=30, completion_tokens=500):
+        self.name = name
+        self.bucket = create_token_bucket("admission:{}".format(name), tokens_per_minute)
+        self.max_wait = max_wait
+        self.completion_tokens = completion_tokens
+
+    def estimate(self, session, max_tokens=None) -> int:
+        """
+        估算本次请求消耗的token数，最多按令牌桶容量预约
+        超过容量的请求永远等不到足够的额度，按容量预约即可在额度补满时放行，超出的部分由reconcile补扣
+        """
+        try:
+            prompt_tokens = session.calc_tokens()
+        except Exception as e:
+            logger.debug("[Admission] calc tokens error, fallback to length: {}".format(e))
+            prompt_tokens = sum(len(str(message.get("content", ""))) for message in session.messages)
+        return min(prompt_tokens + (max_tokens or self.completion_tokens), self.bucket.capacity)
+
+    def _reserve(self, tokens) -> Optional[float]:
+        return self._log_reserve(tokens, self.bucket.reserve(tokens, self.max_wait))
+
+    async def _areserve(self, tokens) -> Optional[float]:
+        return self._log_reserve(tokens, await self.bucket.areserve(tokens, self.max_wait))
+
+    def _log_reserve(self, tokens, wait) -> Optional[float]:
+        if wait is None:
+            logger.warn("[Admission] {} rejected, need {} tokens, wait exceeds {}s".format(self.name, tokens, self.max_wait))
+        elif wait > 0:
+            logger.info("[Admission] {} queued {:.1f}s for {} tokens".format(self.name, wait, tokens))
+        return wait
+
+    def admit(self, tokens) -> bool:
+        """
+        预约tokens个token的额度，额度不足时阻塞等待
+        :return: 等待超过max_wait时不预约并返回False
+        """
+        wait = self._reserve(tokens)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    async def aadmit(self, tokens) -> bool:
+        wait = await self._areserve(tokens)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def reconcile(self, reserved, used):
+        """
+        请求完成后按实际用量调整额度，多预约的归还，少预约的补扣
+        :param reserved: 请求前预约的token数
+        :param used: 实际消耗的token数，请求失败时为0
+        """
+        diff = used - reserved
+        if diff > 0:
+            self.bucket.reserve(diff)
+        elif diff < 0:
+            self.bucket.release(-diff)
+
+    async def areconcile(self, reserved, used):
+        diff = used - reserved
+        if diff > 0:
+            await self.bucket.areserve(diff)
+        elif diff < 0:
+            await self.bucket.arelease(-diff)
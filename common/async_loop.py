@@ -0,0 +1,37 @@
+"""
+全局共享的asyncio事件循环，在后台线程中运行
+异步bot的请求都在这个循环中等待，大量进行中的请求不再各自占用一个线程
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="async_loop", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro) -> Future:
+    """
+    在事件循环中执行协程，返回concurrent.futures.Future，可在其他线程中等待结果或取消
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro, timeout=None):
+    """
+    在同步代码中执行协程并等待结果，不能在事件循环线程中调用
+    """
+    return submit(coro).result(timeout)
@@ -0,0 +1,134 @@
+"""
+消息去重，用于webhook回调的幂等判断
+默认使用一对轮换的布隆过滤器，内存占用固定，不随消息数量增长；配置dedup_store_dir后使用SQLite文件存储，重启后仍然有效，并可在多个进程间共享
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class BloomDedupStore(object):
+    """
+    两个布隆过滤器轮换，每个周期新建一个，key至少保留window_seconds，最多保留2倍window_seconds
+    :param capacity: 单个周期内预计的消息数量，超出后误判率会升高
+    :param error_rate: 误判率，误判时新消息会被当作重复消息丢弃
+    """
+
+    def __init__(self, window_seconds, capacity, error_rate):
+        self.window_seconds = window_seconds
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.rotated_at = time.monotonic()
+
+    def _rotate(self, now):
+        elapsed = now - self.rotated_at
+        if elapsed < self.window_seconds:
+            return
+        # 超过两个周期没有消息时，上一个过滤器也已全部过期
+        self.previous = self.current if elapsed < 2 * self.window_seconds else None
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.rotated_at = now
+
+    def seen(self, key) -> bool:
+        with self.lock:
+            self._rotate(time.monotonic())
+            if key in self.current or (self.previous is not None and key in self.previous):
+                return True
+            self.current.add(key)
+            return False
+
+
+class SqliteDedupStore(object):
+    """
+    基于SQLite文件的去重存储，插入与判断在同一条语句内完成，多进程共享同一文件时也不会重复处理
+    """
+
+    PRUNE_INTERVAL_SECONDS = 600
+
+    def __init__(self, window_seconds, path, table="dedup"):
+        self.window_seconds = window_seconds
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, ts REAL NOT NULL)".format(table))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS {0}_ts ON {0} (ts)".format(table))
+        self.pruned_at = 0
+
+    def seen(self, key) -> bool:
+        # 多进程间需要共享时间，这里使用墙上时间
+        now = time.time()
+        expire_before = now - self.window_seconds
+        with self.lock:
+            if now - self.pruned_at > self.PRUNE_INTERVAL_SECONDS:
+                self.conn.execute("DELETE FROM {} WHERE ts < ?".format(self.table), (expire_before,))
+                self.pruned_at = now
+            cursor = self.conn.execute(
+                "INSERT INTO {0} (key, ts) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET ts = excluded.ts WHERE {0}.ts < ?".format(self.table),
+                (key, now, expire_before),
+            )
+            # 新插入或已过期被更新时rowcount为1，否则为重复消息
+            return cursor.rowcount == 0
+
+
+class DedupStore(object):
+    """
+    按配置选择去重存储
+    :param window_seconds: 去重时间窗口
+    :param name: 存储名称，使用文件存储时不同渠道分别保存
+    """
+
+    def __init__(self, window_seconds, name="default"):
+        from common.state_backend import get_state_backend
+
+        store_dir = conf().get("dedup_store_dir")
+        shared_store = get_state_backend().dedup_store(name, window_seconds)
+        if shared_store:
+            # 多进程共享状态时，去重记录也保存在共享存储中
+            self.store = shared_store
+        elif store_dir:
+            self.store = SqliteDedupStore(window_seconds, os.path.join(store_dir, "dedup_{}.db".format(name)))
+        else:
+            self.store = BloomDedupStore(window_seconds, conf().get("dedup_capacity", 100000), conf().get("dedup_error_rate", 0.000001))
+        logger.debug("[Dedup] {} use {}".format(name, type(self.store).__name__))
+
+    def seen(self, key) -> bool:
+        """
+        判断key是否已出现过，未出现过时记录下来
+        :return: 重复返回True
+        """
+        return self.store.seen(str(key))
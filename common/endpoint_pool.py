@@ -0,0 +1,124 @@
+"""
+多个api key/接口地址的负载均衡
+按观测到的延迟和剩余额度加权随机选择，连续失败或被限流的节点暂时摘除，到期后自动恢复
+"""
+
+import random
+import threading
+import time
+from typing import Optional
+
+from common import retry
+from common.log import logger
+
+
+class Endpoint(object):
+    """
+    :param name: 名称，用于日志，不包含api key
+    :param params: 请求时传给sdk的参数，如api_key、api_base、api_type、api_version、deployment_id
+    :param weight: 基础权重
+    """
+
+    def __init__(self, name, params, weight=1):
+        self.name = name
+        self.params = params
+        self.weight = weight
+        self.latency = None  # 延迟的指数移动平均，秒
+        self.failures = 0  # 连续失败次数
+        self.ejections = 0  # 连续被摘除的次数，用于计算摘除时长
+        self.ejected_until = 0
+        self.remaining = None  # 服务端返回的剩余额度比例，0~1，未知时为None
+        self.inflight = 0
+
+    def score(self) -> float:
+        latency = self.latency or 1.0
+        remaining = 1.0 if self.remaining is None else max(0.05, self.remaining)
+        return self.weight * remaining / (latency * (self.inflight + 1))
+
+
+class EndpointPool(object):
+    """
+    :param endpoints: Endpoint列表
+    :param eject_seconds: 第一次摘除的秒数，连续摘除时翻倍，最长为max_eject_seconds
+    :param failure_threshold: 连续失败多少次后摘除，被限流时立即摘除
+    """
+
+    def __init__(self, endpoints, eject_seconds=30, max_eject_seconds=600, failure_threshold=3):
+        self.endpoints = endpoints
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.failure_threshold = failure_threshold
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self) -> Optional[Endpoint]:
+        """
+        选择一个节点，调用结束后必须调用release
+        全部节点都被摘除时选择最早恢复的节点
+        """
+        if not self.endpoints:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            available = [e for e in self.endpoints if e.ejected_until <= now]
+            if available:
+                endpoint = random.choices(available, weights=[e.score() for e in available])[0]
+            else:
+                endpoint = min(self.endpoints, key=lambda e: e.ejected_until)
+            endpoint.inflight += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency=None, error=None, remaining=None):
+        """
+        记录调用结果
+        :param latency: 本次调用耗时，秒
+        :param error: 调用失败时的异常
+        :param remaining: 服务端返回的剩余额度比例
+        """
+        with self.lock:
+            endpoint.inflight = max(0, endpoint.inflight - 1)
+            if remaining is not None:
+                endpoint.remaining = remaining
+            if error is None:
+                if latency is not None:
+                    endpoint.latency = latency if endpoint.latency is None else endpoint.latency * 0.8 + latency * 0.2
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                return
+            kind = retry.classify_error(error)
+            if kind is None:  # 请求参数错误等与节点无关的错误
+                return
+            endpoint.failures += 1
+            if kind == retry.RATE_LIMIT:
+                endpoint.remaining = 0
+                eject_seconds = retry.error_retry_after(error)
+            elif endpoint.failures >= self.failure_threshold:
+                eject_seconds = None
+            else:
+                return
+            if eject_seconds is None:
+                eject_seconds = min(self.max_eject_seconds, self.eject_seconds * 2 ** endpoint.ejections)
+            endpoint.ejections += 1
+            endpoint.failures = 0
+            endpoint.ejected_until = time.monotonic() + eject_seconds
+        logger.warn("[EndpointPool] eject {} for {:.0f}s, reason={}".format(endpoint.name, eject_seconds, kind))
+
+    @staticmethod
+    def remaining_from_headers(headers) -> Optional[float]:
+        """
+        从x-ratelimit-*响应头计算剩余额度比例，请求数和token数取较小值
+        """
+        if not headers:
+            return None
+        ratios = []
+        for kind in ("requests", "tokens"):
+            try:
+                remaining = headers.get("x-ratelimit-remaining-" + kind)
+                limit = headers.get("x-ratelimit-limit-" + kind)
+                if remaining is not None and limit:
+                    ratios.append(float(remaining) / float(limit))
+            except (TypeError, ValueError):
+                continue
+        return min(ratios) if ratios else None
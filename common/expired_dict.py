@@ -1,22 +1,83 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 
+from common.log import logger
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
+# ExpiredDict读取当前时间使用的时钟，测试中可单独替换，后台清理线程仍使用time模块
+_monotonic = time.monotonic
+
+
+class ExpiredDict(OrderedDict):
+    """
+    带过期时间的字典，每次读写都会刷新key的过期时间
+    所有key的有效期相同，按最近访问顺序保存，最久未访问的key总是最先过期，清理时只需从头部弹出已过期的key
+    :param expires_in_seconds: 过期时间
+    :param max_size: 最大容量，超出时淘汰最久未访问的key，None表示不限制
+    :param on_evict: 过期或超出容量被淘汰时的回调，参数为(key, value)，主动删除时不回调，回调在释放锁之后执行
+    :param sweep_interval: 后台清理过期key的间隔秒数，None表示只在写入时清理
+    """
+
+    def __init__(self, expires_in_seconds, max_size=None, on_evict=None, sweep_interval=60):
         super().__init__()
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.sweep_interval = sweep_interval
+        self._deadlines = {}
+        self._lock = threading.RLock()
+        self._depth = 0  # 当前线程重入锁的层数，只在持有锁时修改
+        self._evicted = []  # 持有锁期间被淘汰的(key, value)，释放锁后再回调
+        if sweep_interval:
+            _sweeper.register(self, sweep_interval)
+
+    @contextmanager
+    def _locked(self):
+        evicted = None
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and self._evicted:
+                    evicted, self._evicted = self._evicted, []
+        if evicted:
+            # 回调可能访问其他加锁的结构，在锁外执行避免死锁
+            for key, value in evicted:
+                try:
+                    self.on_evict(key, value)
+                except Exception as e:
+                    logger.warning("[ExpiredDict] on_evict callback error: {}".format(e))
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._locked():
+            value = super().__getitem__(key)
+            now = _monotonic()
+            if now > self._deadlines[key]:
+                self._evict(key)
+                raise KeyError("expired {}".format(key))
+            self._deadlines[key] = now + self.expires_in_seconds
+            self.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._locked():
+            now = _monotonic()
+            super().__setitem__(key, value)
+            self._deadlines[key] = now + self.expires_in_seconds
+            self.move_to_end(key)
+            self._sweep(now)
+            if self.max_size is not None:
+                while len(self._deadlines) > self.max_size:
+                    self._evict(next(super().__iter__()))
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            del self._deadlines[key]
 
     def get(self, key, default=None):
         try:
@@ -31,12 +92,124 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def pop(self, key, *args):
+        with self._locked():
+            if key in self:
+                value = super().__getitem__(key)
+                del self[key]
+                return value
+            if args:
+                return args[0]
+            raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        with self._locked():
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._deadlines.clear()
+
+    def copy(self):
+        """复制未过期的key，剩余有效期保持不变"""
+        with self._locked():
+            self._sweep(_monotonic())
+            new = self.__class__(self.expires_in_seconds, self.max_size, self.on_evict, self.sweep_interval)
+            for key in super().__iter__():
+                OrderedDict.__setitem__(new, key, super().__getitem__(key))
+            new._deadlines.update(self._deadlines)
+            return new
+
+    def __copy__(self):
+        return self.copy()
+
+    def __reduce__(self):
+        # 锁不能序列化，按构造参数和未过期的key重建，反序列化后所有key重新计算有效期
+        return self.__class__, (self.expires_in_seconds, self.max_size, self.on_evict, self.sweep_interval), None, None, iter(self.items())
+
+    def sweep(self):
+        """清理所有已过期的key"""
+        with self._locked():
+            self._sweep(_monotonic())
+
+    def _sweep(self, now):
+        # 按访问顺序保存，头部的key最先过期，遇到未过期的key即可停止
+        while self._deadlines:
+            key = next(super().__iter__())
+            if self._deadlines[key] >= now:
+                break
+            self._evict(key)
+
+    def _evict(self, key):
+        value = super().__getitem__(key)
+        super().__delitem__(key)
+        del self._deadlines[key]
+        if self.on_evict:
+            self._evicted.append((key, value))
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self._locked():
+            self._sweep(_monotonic())
+            return list(super().__iter__())
+
+    def values(self):
+        with self._locked():
+            self._sweep(_monotonic())
+            return [super(ExpiredDict, self).__getitem__(key) for key in super().__iter__()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self._locked():
+            self._sweep(_monotonic())
+            return [(key, super(ExpiredDict, self).__getitem__(key)) for key in super().__iter__()]
 
     def __iter__(self):
-        return self.keys().__iter__()
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._locked():
+            self._sweep(_monotonic())
+            return super().__len__()
+
+
+class _Sweeper(object):
+    """所有ExpiredDict共用的后台清理线程"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []  # [ExpiredDict弱引用, 清理间隔, 下次清理时间]
+        self.thread = None
+
+    def register(self, expired_dict, interval):
+        with self.lock:
+            self.entries.append([weakref.ref(expired_dict), interval, time.monotonic() + interval])
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="expired_dict_sweeper", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            due = []
+            with self.lock:
+                self.entries = [entry for entry in self.entries if entry[0]() is not None]
+                for entry in self.entries:
+                    if entry[2] <= now:
+                        entry[2] = now + entry[1]
+                        due.append(entry[0]())
+            for d in due:
+                if d is None:
+                    continue
+                try:
+                    d.sweep()
+                except Exception as e:
+                    logger.warning("[ExpiredDict] sweep error: {}".format(e))
+            del due
+
+
+_sweeper = _Sweeper()
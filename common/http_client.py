@@ -0,0 +1,55 @@
+"""
+共享的HTTP客户端，复用连接池，避免每次请求重新建立TCP和TLS连接
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import conf
+
+DEFAULT_TIMEOUT = (5, 60)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    获取全局共享的requests.Session，按host维护keep-alive连接池
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=conf().get("http_pool_connections", 10),
+                    pool_maxsize=conf().get("http_pool_maxsize", 20),
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs) -> requests.Response:
+    return request("PUT", url, **kwargs)
+
+
+def patch(url, **kwargs) -> requests.Response:
+    return request("PATCH", url, **kwargs)
@@ -0,0 +1,172 @@
+"""
+图片缓存，按内容哈希在磁盘保存图片，资源key到内容哈希的映射也保存在磁盘上，重启后仍可命中，图片识别结果只保存在内存中
+同一张图片被重复发送、引用或转发时，无需再次下载和识别
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+MAX_KEYS = 10000  # 资源key映射的最大数量
+KEYS_DIR = "keys"  # 资源key映射保存在缓存目录下的子目录中，文件名为key的哈希，内容为图片的内容哈希
+
+
+def file_hash(file_path) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@singleton
+class ImageCache(object):
+    def __init__(self):
+        self.cache_dir = conf().get("image_cache_dir") or os.path.join(get_appdata_dir(), "image_cache")
+        self.max_bytes = conf().get("image_cache_max_bytes", 200 * 1024 * 1024)
+        self.max_descriptions = conf().get("image_cache_max_descriptions", 1000)
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # 内容哈希 -> 文件大小，按最近使用排序
+        self.keys = OrderedDict()  # 资源key的哈希 -> 内容哈希
+        self.descriptions = OrderedDict()  # 识别请求key -> 识别结果
+        self.total_bytes = 0
+        self.keys_dir = os.path.join(self.cache_dir, KEYS_DIR)
+        os.makedirs(self.keys_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.total_bytes += size
+        self._evict()
+        key_entries = []
+        for name in os.listdir(self.keys_dir):
+            path = os.path.join(self.keys_dir, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    content_hash = f.read().strip()
+                key_entries.append((os.stat(path).st_mtime, name, content_hash))
+            except OSError:
+                continue
+        for _, name, content_hash in sorted(key_entries):
+            if content_hash in self.files:
+                self.keys[name] = content_hash
+            else:
+                self._remove_key_file(name)
+        self._evict_keys()
+        logger.debug("[ImageCache] loaded {} files, {} bytes, {} keys".format(len(self.files), self.total_bytes, len(self.keys)))
+
+    def _path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash)
+
+    @staticmethod
+    def _key_name(key) -> str:
+        return hashlib.sha256(str(key).encode("utf-8")).hexdigest()
+
+    def _remove_key_file(self, name):
+        try:
+            os.remove(os.path.join(self.keys_dir, name))
+        except OSError:
+            pass
+
+    def _evict_keys(self):
+        while len(self.keys) > MAX_KEYS:
+            name, _ = self.keys.popitem(last=False)
+            self._remove_key_file(name)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.files:
+            content_hash, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(content_hash))
+            except OSError:
+                pass
+
+    def get_file(self, key, dest_path) -> bool:
+        """
+        将资源key对应的缓存图片复制到dest_path
+        :return: 命中缓存返回True
+        """
+        name = self._key_name(key)
+        with self.lock:
+            content_hash = self.keys.get(name)
+            if content_hash is None or content_hash not in self.files:
+                return False
+            self.keys.move_to_end(name)
+            self.files.move_to_end(content_hash)
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.part"
+        try:
+            shutil.copyfile(self._path(content_hash), tmp_path)
+            os.replace(tmp_path, dest_path)
+            return True
+        except OSError as e:
+            logger.warning("[ImageCache] read cache error: {}".format(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def put_file(self, key, src_path):
+        """
+        缓存已下载的图片，key为资源key(如飞书image_key)
+        """
+        name = self._key_name(key)
+        try:
+            content_hash = file_hash(src_path)
+            with self.lock:
+                if content_hash not in self.files:
+                    shutil.copyfile(src_path, self._path(content_hash))
+                    size = os.path.getsize(self._path(content_hash))
+                    self.files[content_hash] = size
+                    self.total_bytes += size
+                self.files.move_to_end(content_hash)
+                if self.keys.get(name) != content_hash:
+                    key_path = os.path.join(self.keys_dir, name)
+                    tmp_path = f"{key_path}.{uuid.uuid4().hex}.part"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.write(content_hash)
+                    os.replace(tmp_path, key_path)
+                self.keys[name] = content_hash
+                self.keys.move_to_end(name)
+                self._evict_keys()
+                self._evict()
+        except OSError as e:
+            logger.warning("[ImageCache] write cache error: {}".format(e))
+
+    def description_key(self, image_files, *args) -> str:
+        """
+        根据图片内容和识别参数(模型、提问等)生成识别结果的缓存key
+        """
+        sha = hashlib.sha256()
+        for image_file in image_files:
+            sha.update(file_hash(image_file).encode("utf-8"))
+        for arg in args:
+            sha.update(b"\0" + str(arg).encode("utf-8"))
+        return sha.hexdigest()
+
+    def get_description(self, desc_key):
+        with self.lock:
+            description = self.descriptions.get(desc_key)
+            if description is not None:
+                self.descriptions.move_to_end(desc_key)
+            return description
+
+    def put_description(self, desc_key, description):
+        with self.lock:
+            self.descriptions[desc_key] = description
+            self.descriptions.move_to_end(desc_key)
+            while len(self.descriptions) > self.max_descriptions:
+                self.descriptions.popitem(last=False)
@@ -0,0 +1,155 @@
+"""
+模型请求的重试策略，各bot共用
+按错误类型决定是否重试，指数退避并加入随机抖动，优先使用服务端返回的Retry-After，且总耗时不超过截止时间
+同步调用使用time.sleep等待，异步调用(areply)使用asyncio.sleep等待，不占用线程
+同步的reply需要直接返回结果，重试只能在当前线程中等待，无法改为定时重新提交到线程池，
+因此同步调用的等待总时长受retry_sync_max_wait限制，超出后不再重试，避免长时间占用处理线程；
+需要按完整的退避策略和Retry-After重试时开启async_reply，使用支持异步的bot
+"""
+
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from config import conf
+
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+SERVER = "server"
+CONNECTION = "connection"
+
+# 各类错误第一次重试的基础等待秒数，之后每次翻倍
+BASE_DELAYS = {
+    RATE_LIMIT: 5,
+    TIMEOUT: 1,
+    SERVER: 2,
+    CONNECTION: 1,
+}
+
+
+def _status_code(e) -> Optional[int]:
+    for status in (getattr(e, "status_code", None), getattr(e, "http_status", None), getattr(getattr(e, "response", None), "status_code", None)):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def classify_status(status_code) -> Optional[str]:
+    if status_code == 429:
+        return RATE_LIMIT
+    if status_code == 408:
+        return TIMEOUT
+    if status_code is not None and status_code >= 500:
+        return SERVER
+    return None
+
+
+def classify_error(e) -> Optional[str]:
+    """
+    判断异常的类型，返回None表示不可重试
+    按异常类名判断，兼容openai、zhipuai、requests等不同sdk，无需导入各sdk的异常类
+    """
+    name = type(e).__name__
+    if "RateLimit" in name:
+        return RATE_LIMIT
+    if "Timeout" in name or isinstance(e, TimeoutError):
+        return TIMEOUT
+    kind = classify_status(_status_code(e))
+    if kind:
+        return kind
+    if "Connection" in name or isinstance(e, ConnectionError):
+        return CONNECTION
+    if name in ("APIError", "ServiceUnavailableError", "InternalServerError") and _status_code(e) is None:
+        return SERVER
+    return None
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    解析Retry-After响应头，支持秒数和HTTP日期两种格式
+    """
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms") or headers.get("Retry-After-Ms")
+        if value:
+            return float(value) / 1000
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def error_retry_after(e) -> Optional[float]:
+    headers = getattr(e, "headers", None) or getattr(getattr(e, "response", None), "headers", None)
+    return parse_retry_after(headers)
+
+
+class RetryPolicy(object):
+    """
+    :param max_retries: 最大重试次数
+    :param max_delay: 单次等待的最长秒数
+    :param deadline: 从第一次请求开始的总时长上限，超过后不再重试
+    :param sync_max_wait: 同步调用在处理线程中等待重试的总秒数上限
+    :param classify: 异常分类函数，返回None表示不可重试
+    """
+
+    def __init__(self, max_retries=None, max_delay=None, deadline=None, sync_max_wait=None, classify=classify_error):
+        self.max_retries = conf().get("retry_max_times", 2) if max_retries is None else max_retries
+        self.max_delay = conf().get("retry_max_delay", 30) if max_delay is None else max_delay
+        self.deadline = conf().get("retry_deadline", 60) if deadline is None else deadline
+        self.sync_max_wait = conf().get("retry_sync_max_wait", 10) if sync_max_wait is None else sync_max_wait
+        self.classify = classify
+
+    def start(self, attempts=0, blocking=True) -> "RetryState":
+        """
+        开始一次请求，返回记录重试状态的对象
+        :param attempts: 已经重试过的次数
+        :param blocking: 是否在处理线程中同步等待重试，异步调用传入False
+        """
+        return RetryState(self, attempts, blocking)
+
+
+class RetryState(object):
+    def __init__(self, policy: RetryPolicy, attempts=0, blocking=True):
+        self.policy = policy
+        self.attempts = attempts
+        self.blocking = blocking
+        self.waited = 0.0  # 同步调用已经等待的秒数
+        self.started_at = time.monotonic()
+
+    def next_delay(self, error=None, kind=None, retry_after=None) -> Optional[float]:
+        """
+        计算下次重试前需要等待的秒数
+        :param error: 请求抛出的异常，用于判断错误类型和读取Retry-After
+        :param kind: 错误类型，没有异常(如根据状态码判断失败)时直接传入
+        :param retry_after: 服务端要求的等待秒数
+        :return: 等待秒数，不需要重试时返回None
+        """
+        if kind is None and error is not None:
+            kind = self.policy.classify(error)
+        if kind is None or self.attempts >= self.policy.max_retries:
+            return None
+        if retry_after is None and error is not None:
+            retry_after = error_retry_after(error)
+        backoff = min(self.policy.max_delay, BASE_DELAYS.get(kind, 1) * 2 ** self.attempts)
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if time.monotonic() - self.started_at + delay > self.policy.deadline:
+            return None
+        if self.blocking:
+            # 同步等待会占用处理线程，退避时间截断到剩余额度，服务端要求的等待时间超出额度时直接放弃
+            remaining = self.policy.sync_max_wait - self.waited
+            if remaining <= 0 or (retry_after is not None and retry_after > remaining):
+                return None
+            delay = min(delay, remaining)
+            self.waited += delay
+        self.attempts += 1
+        return delay
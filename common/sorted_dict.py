@@ -1,65 +1,85 @@
-import heapq
+import bisect
 
 
 class SortedDict(dict):
+    """
+    按sort_func计算的优先级排序的字典
+    内部维护按(优先级, key)升序排列的列表和key到当前优先级的索引，增删和调整优先级时二分查找定位，无需遍历和重建堆
+    定位是O(log n)，但在列表中插入和删除元素仍需移动后面的元素，是O(n)的内存搬移，对插件数量级的字典足够快
+    有序的keys和items会被缓存，只在内容或优先级变化后重新生成，返回的是缓存的副本，调用方可以修改
+    """
+
     def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
         if init_dict is None:
             init_dict = []
         if isinstance(init_dict, dict):
             init_dict = init_dict.items()
         self.sort_func = sort_func
-        self.sorted_keys = None
         self.reverse = reverse
-        self.heap = []
+        self._entries = []  # 按(优先级, key)升序排列
+        self._priorities = {}  # key -> 当前优先级
+        self._sorted_keys = None
+        self._sorted_items = None
         for k, v in init_dict:
             self[k] = v
 
+    def _insert_entry(self, key, priority):
+        bisect.insort(self._entries, (priority, key))
+        self._priorities[key] = priority
+
+    def _remove_entry(self, key):
+        entry = (self._priorities.pop(key), key)
+        i = bisect.bisect_left(self._entries, entry)
+        del self._entries[i]
+
+    def _invalidate(self):
+        self._sorted_keys = None
+        self._sorted_items = None
+
     def __setitem__(self, key, value):
-        if key in self:
-            super().__setitem__(key, value)
-            for i, (priority, k) in enumerate(self.heap):
-                if k == key:
-                    self.heap[i] = (self.sort_func(key, value), key)
-                    heapq.heapify(self.heap)
-                    break
-            self.sorted_keys = None
-        else:
-            super().__setitem__(key, value)
-            heapq.heappush(self.heap, (self.sort_func(key, value), key))
-            self.sorted_keys = None
+        super().__setitem__(key, value)
+        priority = self.sort_func(key, value)
+        if key in self._priorities:
+            if self._priorities[key] == priority:
+                self._sorted_items = None  # 顺序不变，只有value变化
+                return
+            self._remove_entry(key)
+        self._insert_entry(key, priority)
+        self._invalidate()
 
     def __delitem__(self, key):
         super().__delitem__(key)
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                del self.heap[i]
-                heapq.heapify(self.heap)
-                break
-        self.sorted_keys = None
+        self._remove_entry(key)
+        self._invalidate()
+
+    def _sorted_keys_cache(self):
+        if self._sorted_keys is None:
+            keys = [k for _, k in self._entries]
+            if self.reverse:
+                keys.reverse()
+            self._sorted_keys = tuple(keys)
+        return self._sorted_keys
 
     def keys(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        return self.sorted_keys
+        return list(self._sorted_keys_cache())
 
     def items(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        sorted_items = [(k, self[k]) for k in self.sorted_keys]
-        return sorted_items
+        if self._sorted_items is None:
+            self._sorted_items = tuple((k, self[k]) for k in self._sorted_keys_cache())
+        return list(self._sorted_items)
 
     def _update_heap(self, key):
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                new_priority = self.sort_func(key, self[key])
-                if new_priority != priority:
-                    self.heap[i] = (new_priority, key)
-                    heapq.heapify(self.heap)
-                    self.sorted_keys = None
-                break
+        """
+        value内部的属性变化导致优先级变化后调用，重新计算key的位置
+        """
+        priority = self.sort_func(key, self[key])
+        if self._priorities[key] != priority:
+            self._remove_entry(key)
+            self._insert_entry(key, priority)
+            self._invalidate()
 
     def __iter__(self):
-        return iter(self.keys())
+        return iter(self._sorted_keys_cache())
 
     def __repr__(self):
         return f"{type(self).__name__}({dict(self)}, sort_func={self.sort_func.__name__}, reverse={self.reverse})"
@@ -0,0 +1,330 @@
+"""
+运行状态存储，包括会话上下文、会话处理锁和消息去重记录
+memory: 保存在进程内存中(默认)，只适用于单进程
+sqlite: 保存在本地SQLite文件中，重启后会话不丢失，同一台机器上的多个进程共享，可以多进程同时处理同一个飞书应用的消息，且同一会话的消息不会同时处理
+       会话处理锁只保证互斥，不保证多个进程间等待同一会话的消息按到达顺序处理，单个进程内的顺序由ChatChannel的队列保证
+       会话按消息逐条存储，每轮对话只写入变化的消息，内存中的会话可以随时淘汰，再次访问时从文件中加载
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class StateBackend(object):
+    # 是否在多个进程间共享并持久化，为True时会话需要从存储中读取，并在变化时写回
+    shared = False
+
+    def __init__(self):
+        # 不共享的存储使用进程内的令牌桶，空闲足够久后令牌已补满，与新建的令牌桶等价，可以直接丢弃
+        self.token_buckets = ExpiredDict(600)
+        self.token_buckets_lock = threading.Lock()
+
+    def session_version(self, session_id):
+        """
+        会话在存储中的版本号，会话不存在或已过期时返回None
+        """
+        return None
+
+    def load_session(self, session_id):
+        """
+        :return: (messages, seqs, version)，seqs为每条消息在存储中的序号，会话不存在或已过期时返回None
+        """
+        return None
+
+    def update_session(self, session_id, deleted_seqs, new_messages, replace=False):
+        """
+        增量更新会话，删除指定序号的消息并在末尾追加新消息
+        :param replace: 为True时先删除会话的全部消息，new_messages为会话的全部消息
+        :return: (新消息的序号列表, 更新后的版本号)，非replace时存储中的会话不存在或已过期则不写入并返回None，需要用全部消息重新写入
+        """
+        return [], None
+
+    def delete_session(self, session_id):
+        pass
+
+    def clear_sessions(self):
+        pass
+
+    @contextmanager
+    def session_lock(self, session_id):
+        """
+        会话处理锁，保证同一会话的消息在多个进程间不会同时处理，只提供互斥，不保证等待者按先后顺序获得锁
+        """
+        yield
+
+    def dedup_store(self, name, window_seconds):
+        """
+        返回共享的去重存储，不支持时返回None
+        """
+        return None
+
+    def reserve_tokens(self, key, rate, capacity, n=1, max_wait=None):
+        """
+        从令牌桶中预约令牌，同名的令牌桶在共享该存储的所有进程间共享，不共享的存储只在进程内生效
+        :return: 需要等待的秒数，超过max_wait时不预约并返回None
+        """
+        from common.token_bucket import TokenBucket
+
+        with self.token_buckets_lock:
+            bucket = self.token_buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(capacity)
+                bucket.rate = rate
+                self.token_buckets[key] = bucket
+        return bucket.reserve(n, max_wait)
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    会话保存在SessionManager的内存中，会话顺序由ChatChannel的信号量保证，这里无需额外处理
+    """
+
+    pass
+
+
+class SqliteStateBackend(StateBackend):
+    shared = True
+    PRUNE_INTERVAL_SECONDS = 600
+
+    def __init__(self, path, session_expires_in_seconds=None, lock_lease_seconds=300):
+        super().__init__()
+        self.path = path
+        self.session_expires_in_seconds = session_expires_in_seconds
+        self.lock_lease_seconds = lock_lease_seconds
+        self.local = threading.local()
+        self.pruned_at = 0
+        self.held_locks = {}  # owner -> session_id，持有期间由心跳线程续租
+        self.held_locks_lock = threading.Lock()
+        self.heartbeat_thread = None
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, next_seq INTEGER NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS session_messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (session_id, seq))")
+        conn.execute("CREATE TABLE IF NOT EXISTS session_locks (session_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expire_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite连接不能跨线程并发使用，每个线程使用独立的连接
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def _expire_before(self):
+        # 与内存中的会话一致，超过expires_in_seconds未更新的会话视为已过期
+        if not self.session_expires_in_seconds:
+            return 0
+        return time.time() - self.session_expires_in_seconds
+
+    def session_version(self, session_id):
+        row = self._conn().execute("SELECT version FROM sessions WHERE session_id = ? AND updated_at >= ?", (session_id, self._expire_before())).fetchone()
+        return row[0] if row else None
+
+    def load_session(self, session_id):
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT version FROM sessions WHERE session_id = ? AND updated_at >= ?", (session_id, self._expire_before())).fetchone()
+            rows = conn.execute("SELECT seq, message FROM session_messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall() if row else []
+        finally:
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        return [json.loads(message) for _, message in rows], [seq for seq, _ in rows], row[0]
+
+    def update_session(self, session_id, deleted_seqs, new_messages, replace=False):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next_seq, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if not replace and (row is None or row[1] < self._expire_before()):
+                # 增量数据基于已不存在的会话，只写入新消息会丢失之前的内容
+                conn.execute("ROLLBACK")
+                return None
+            if row is None:
+                next_seq = 0
+            elif replace:
+                conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+                next_seq = row[0]
+            else:
+                next_seq = row[0]
+                conn.executemany("DELETE FROM session_messages WHERE session_id = ? AND seq = ?", [(session_id, seq) for seq in deleted_seqs])
+            seqs = list(range(next_seq, next_seq + len(new_messages)))
+            conn.executemany(
+                "INSERT INTO session_messages (session_id, seq, message) VALUES (?, ?, ?)",
+                [(session_id, seq, json.dumps(message, ensure_ascii=False)) for seq, message in zip(seqs, new_messages)],
+            )
+            conn.execute(
+                "INSERT INTO sessions (session_id, version, next_seq, updated_at) VALUES (?, 1, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET version = sessions.version + 1, next_seq = excluded.next_seq, updated_at = excluded.updated_at",
+                (session_id, next_seq + len(new_messages), now),
+            )
+            version = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if self.session_expires_in_seconds and now - self.pruned_at > self.PRUNE_INTERVAL_SECONDS:
+            self.pruned_at = now
+            self._prune_sessions()
+        return seqs, version
+
+    def _prune_sessions(self):
+        conn = self._conn()
+        expire_before = self._expire_before()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM session_messages WHERE session_id IN (SELECT session_id FROM sessions WHERE updated_at < ?)", (expire_before,))
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (expire_before,))
+            conn.execute("COMMIT")
+        except Exception as e:
+            conn.execute("ROLLBACK")
+            logger.warning("[StateBackend] prune sessions error: {}".format(e))
+
+    def delete_session(self, session_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear_sessions(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM session_messages")
+            conn.execute("DELETE FROM sessions")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @contextmanager
+    def session_lock(self, session_id):
+        """
+        通过轮询获取租约锁，等待间隔从10ms指数增长到500ms，等待期间会阻塞当前线程，
+        最长等待时间为其他进程持有锁的处理时长，持有锁的进程异常退出时最长为一个租期(state_lock_lease_seconds)
+        异步处理时在线程池中调用，不会阻塞事件循环
+        """
+        if session_id is None:
+            yield
+            return
+        conn = self._conn()
+        owner = uuid.uuid4().hex
+        wait = 0.01
+        while True:
+            now = time.time()
+            # 锁有租期，持有锁的进程异常退出后，租期结束即可被其他进程获取
+            cursor = conn.execute(
+                "INSERT INTO session_locks (session_id, owner, expire_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET owner = excluded.owner, expire_at = excluded.expire_at WHERE session_locks.expire_at < ?",
+                (session_id, owner, now + self.lock_lease_seconds, now),
+            )
+            if cursor.rowcount == 1:
+                break
+            time.sleep(wait)
+            wait = min(wait * 2, 0.5)
+        self._hold_lock(owner, session_id)
+        try:
+            yield
+        finally:
+            with self.held_locks_lock:
+                self.held_locks.pop(owner, None)
+            # 异步处理时加锁和释放可能在不同线程中执行，需要使用当前线程的连接
+            self._conn().execute("DELETE FROM session_locks WHERE session_id = ? AND owner = ?", (session_id, owner))
+
+    def _hold_lock(self, owner, session_id):
+        with self.held_locks_lock:
+            self.held_locks[owner] = session_id
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self._heartbeat, name="state_lock_heartbeat", daemon=True)
+                self.heartbeat_thread.start()
+
+    def _heartbeat(self):
+        """
+        定期为持有的会话锁续租，处理时间超过租期时锁也不会被其他进程抢走，进程退出后心跳停止，租期结束即可被获取
+        """
+        interval = max(self.lock_lease_seconds / 3, 0.1)
+        while True:
+            time.sleep(interval)
+            with self.held_locks_lock:
+                held = list(self.held_locks.items())
+            if not held:
+                continue
+            expire_at = time.time() + self.lock_lease_seconds
+            try:
+                conn = self._conn()
+                for owner, session_id in held:
+                    cursor = conn.execute("UPDATE session_locks SET expire_at = ? WHERE session_id = ? AND owner = ?", (expire_at, session_id, owner))
+                    if cursor.rowcount == 0:
+                        with self.held_locks_lock:
+                            still_held = owner in self.held_locks
+                        if still_held:
+                            logger.warning("[StateBackend] lost session lock of {}, lease expired before renewal".format(session_id))
+            except Exception as e:
+                logger.warning("[StateBackend] renew session locks error: {}".format(e))
+
+    def reserve_tokens(self, key, rate, capacity, n=1, max_wait=None):
+        conn = self._conn()
+        # 多进程间需要共享时间，这里使用墙上时间
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            wait = max(0.0, (n - tokens) / rate)
+            if max_wait is not None and wait > max_wait:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute(
+                "INSERT INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (key, min(capacity, tokens - n), now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def dedup_store(self, name, window_seconds):
+        from common.dedup import SqliteDedupStore
+
+        return SqliteDedupStore(window_seconds, self.path, table="dedup_{}".format(name))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_type = conf().get("state_backend", "memory")
+                if backend_type == "sqlite":
+                    path = conf().get("state_backend_path") or os.path.join(get_appdata_dir(), "state.db")
+                    _backend = SqliteStateBackend(path, conf().get("expires_in_seconds"), conf().get("state_lock_lease_seconds", 300))
+                else:
+                    _backend = MemoryStateBackend()
+                logger.info("[StateBackend] use {}".format(type(_backend).__name__))
+    return _backend
@@ -1,39 +1,145 @@
+import asyncio
 import threading
 import time
 
+from common.expired_dict import ExpiredDict
+
+
+class RateLimiter(object):
+    """
+    令牌桶限流的公共逻辑，子类实现reserve
+    获取令牌时先预约，令牌不足时计算出需要等待的时间后直接等待，无需后台线程定时补充令牌
+    """
+
+    timeout = None  # 等待令牌超时时间，None表示一直等待
+
+    def reserve(self, n=1, max_wait=None):
+        """
+        预约n个令牌
+        :param max_wait: 最长可接受的等待秒数，None表示不限制
+        :return: 需要等待的秒数，超过max_wait时不预约并返回None
+        """
+        raise NotImplementedError
+
+    def get_token(self, timeout=-1):
+        """获取令牌，令牌不足时阻塞等待"""
+        wait = self.reserve(1, self.timeout if timeout == -1 else timeout)
+        if wait is None:  # 超时
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def release(self, n=1):
+        """归还预约了但没有用掉的令牌"""
+        self.reserve(-n)
+
+    async def areserve(self, n=1, max_wait=None):
+        """reserve的异步版本，进程内的令牌桶只做内存计算，直接在事件循环中执行"""
+        return self.reserve(n, max_wait)
+
+    async def arelease(self, n=1):
+        await self.areserve(-n)
+
+    async def aget_token(self, timeout=-1):
+        """获取令牌，令牌不足时在事件循环中等待，不占用线程"""
+        wait = await self.areserve(1, self.timeout if timeout == -1 else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def close(self):
+        pass
+
+
+class TokenBucket(RateLimiter):
+    """
+    进程内的令牌桶，每次获取令牌时根据经过的时间补充令牌
+    :param tpm: 每分钟生成的令牌数，也是令牌桶容量
+    :param timeout: 等待令牌超时时间
+    """
 
-class TokenBucket:
     def __init__(self, tpm, timeout=None):
         self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
-        self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
-        return True
+        self.timeout = timeout
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
 
-    def close(self):
-        self.is_running = False
+    def reserve(self, n=1, max_wait=None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # 令牌可以预支为负数，等待时间即补齐欠下的令牌所需的时间，先到先得
+            wait = max(0.0, (n - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens = min(self.capacity, self.tokens - n)
+            return wait
+
+
+class SharedTokenBucket(RateLimiter):
+    """
+    多进程共享的令牌桶，令牌数保存在共享的状态存储中
+    """
+
+    def __init__(self, key, tpm, backend, timeout=None):
+        self.key = key
+        self.capacity = int(tpm)
+        self.rate = int(tpm) / 60
+        self.backend = backend
+        self.timeout = timeout
+
+    def reserve(self, n=1, max_wait=None):
+        return self.backend.reserve_tokens(self.key, self.rate, self.capacity, n, max_wait)
+
+    async def areserve(self, n=1, max_wait=None):
+        # 共享存储的写事务可能要等其他进程释放写锁，放到线程池中执行，避免阻塞事件循环
+        return await asyncio.get_running_loop().run_in_executor(None, self.reserve, n, max_wait)
+
+
+class KeyedTokenBucket(object):
+    """
+    按key(用户、api key、模型等)分别限流，每个key使用独立的令牌桶，长时间未使用的令牌桶会被清理
+    """
+
+    def __init__(self, name, tpm, timeout=None):
+        self.name = name
+        self.tpm = tpm
+        self.timeout = timeout
+        # 空闲足够久后令牌已补满，与新建的令牌桶等价，可以直接丢弃
+        self.buckets = ExpiredDict(600, max_size=100000)
+        self.lock = threading.Lock()
+
+    def bucket(self, key) -> RateLimiter:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = create_token_bucket("{}:{}".format(self.name, key), self.tpm, self.timeout)
+                self.buckets[key] = bucket
+            return bucket
+
+    def get_token(self, key, timeout=-1):
+        return self.bucket(key).get_token(timeout)
+
+    async def aget_token(self, key, timeout=-1):
+        return await self.bucket(key).aget_token(timeout)
+
+
+def create_token_bucket(name, tpm, timeout=None) -> RateLimiter:
+    """
+    创建令牌桶，使用多进程共享的状态存储时，同名的令牌桶在所有进程间共享
+    """
+    from common.state_backend import get_state_backend
+
+    backend = get_state_backend()
+    if backend.shared:
+        return SharedTokenBucket(name, tpm, backend, timeout)
+    return TokenBucket(tpm, timeout)
 
 
 if __name__ == "__main__":
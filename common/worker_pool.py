@@ -0,0 +1,121 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+
+
+class WorkerPool(ThreadPoolExecutor):
+    """
+    带运行统计的线程池
+    线程按需创建，最多扩容到max_workers，可统计排队数、活跃线程数以及任务排队等待时间
+    """
+
+    def __init__(self, name, max_workers, slow_wait_seconds=None, initializer=None):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"{name}_pool", initializer=initializer)
+        self.name = name
+        self.slow_wait_seconds = slow_wait_seconds  # 排队时间超过该值时打印告警
+        self._stats_lock = threading.Lock()
+        self._pending = 0  # 已提交但尚未开始执行的任务数
+        self._active = 0  # 正在执行的任务数
+        self._submitted = 0
+        self._started = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        submit_time = time.monotonic()
+
+        def _run():
+            wait = time.monotonic() - submit_time
+            with self._stats_lock:
+                self._pending -= 1
+                self._active += 1
+                self._started += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            if self.slow_wait_seconds and wait > self.slow_wait_seconds:
+                logger.warning("[WorkerPool] {} task waited {:.2f}s in queue, stats={}".format(self.name, wait, self.stats()))
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self._active -= 1
+                    self._completed += 1
+
+        with self._stats_lock:
+            self._pending += 1
+            self._submitted += 1
+        try:
+            future = super().submit(_run)
+        except Exception:
+            with self._stats_lock:
+                self._pending -= 1
+                self._submitted -= 1
+            raise
+        # 排队中被取消的任务不会执行_run，需要在这里修正计数
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        if future.cancelled():
+            with self._stats_lock:
+                self._pending -= 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "name": self.name,
+                "max_workers": self._max_workers,
+                "threads": len(self._threads),
+                "active": self._active,
+                "pending": self._pending,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "avg_wait": round(self._total_wait / self._started, 3) if self._started > 0 else 0.0,
+                "max_wait": round(self._max_wait, 3),
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_initializer = None
+
+
+def get_pool(name, max_workers, slow_wait_seconds=None) -> WorkerPool:
+    """
+    获取指定名称的线程池，不存在时创建
+    :param name: 线程池名称
+    :param max_workers: 线程池最大线程数，仅在创建时生效
+    :param slow_wait_seconds: 任务排队超过该秒数时打印告警
+    """
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = WorkerPool(name, max_workers, slow_wait_seconds=slow_wait_seconds, initializer=_initializer)
+                _pools[name] = pool
+                logger.info("[WorkerPool] create pool {}, max_workers={}".format(name, max_workers))
+    return pool
+
+
+def all_pools() -> list:
+    with _pools_lock:
+        return list(_pools.values())
+
+
+def set_initializer(initializer):
+    """
+    设置线程初始化函数，对已创建的线程池中新建的线程同样生效
+    """
+    global _initializer
+    with _pools_lock:
+        _initializer = initializer
+        for pool in _pools.values():
+            pool._initializer = initializer
+
+
+def pool_stats() -> list:
+    return [pool.stats() for pool in all_pools()]
@@ -0,0 +1,129 @@
+"""
+HTTP服务，在独立线程中运行WSGI应用，限制并发请求数，并支持收到退出信号后等待处理中的请求完成
+server_type可选:
+    threaded: werkzeug多线程服务(默认)
+    waitress: waitress线程池服务，需要 pip install waitress
+多进程部署时可不经过本模块，直接使用 gunicorn -w 4 "app:create_app()"
+"""
+
+import threading
+import time
+
+from common.log import logger
+from config import conf
+
+BUSY_RESPONSE = b'{"success": false, "msg": "server busy"}'
+
+
+class ConcurrencyLimiter(object):
+    """
+    限制同时处理的请求数的WSGI中间件，超出时最多排队queue_timeout秒，仍无空闲则返回503
+    """
+
+    def __init__(self, app, max_concurrency, queue_timeout):
+        self.app = app
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.draining = False
+
+    def __call__(self, environ, start_response):
+        if self.draining:
+            return self._reject(start_response, "draining")
+        if self.semaphore and not self.semaphore.acquire(timeout=self.queue_timeout):
+            logger.warning("[Server] too many concurrent requests, path={}".format(environ.get("PATH_INFO")))
+            return self._reject(start_response, "busy")
+        with self.cond:
+            if self.draining:
+                if self.semaphore:
+                    self.semaphore.release()
+                return self._reject(start_response, "draining")
+            self.in_flight += 1
+        try:
+            # 在计数范围内生成完整的响应体，保证drain时不会中断正在返回的响应
+            result = self.app(environ, start_response)
+            try:
+                return list(result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+            if self.semaphore:
+                self.semaphore.release()
+
+    def _reject(self, start_response, reason):
+        start_response("503 Service Unavailable", [("Content-Type", "application/json"), ("Retry-After", "1"), ("X-Reject-Reason", reason)])
+        return [BUSY_RESPONSE]
+
+    def drain(self, timeout) -> bool:
+        """
+        不再接收新请求，等待处理中的请求完成
+        :return: 全部完成返回True，超时返回False
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.draining = True
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+
+class WSGIServer(object):
+    def __init__(self, app, host, port):
+        self.host = host
+        self.port = port
+        self.server_type = conf().get("server_type", "threaded")
+        self.limiter = ConcurrencyLimiter(app, conf().get("server_max_concurrency", 64), conf().get("server_queue_timeout", 5))
+        self.server = None
+        self.thread = None
+
+    def _create_server(self):
+        if self.server_type == "waitress":
+            try:
+                import waitress
+            except ImportError:
+                logger.error("[Server] waitress not installed, please run: pip install waitress")
+                raise
+            return waitress.create_server(self.limiter, host=self.host, port=self.port, threads=conf().get("server_threads", 16))
+        from werkzeug.serving import make_server
+
+        return make_server(self.host, self.port, self.limiter, threaded=True)
+
+    def start(self):
+        self.server = self._create_server()
+        run = self.server.run if self.server_type == "waitress" else self.server.serve_forever
+        self.thread = threading.Thread(target=run, name="wsgi_server", daemon=True)
+        self.thread.start()
+        logger.info("[Server] {} server listening on {}:{}".format(self.server_type, self.host, self.port))
+
+    def serve_forever(self):
+        """
+        启动服务并阻塞主线程，退出信号由主线程处理
+        """
+        self.start()
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+    def drain(self):
+        """
+        收到退出信号时调用，等待处理中的请求完成后停止监听
+        """
+        timeout = conf().get("server_drain_timeout", 30)
+        logger.info("[Server] draining in-flight requests, count={}, timeout={}s".format(self.limiter.in_flight, timeout))
+        if not self.limiter.drain(timeout):
+            logger.warning("[Server] drain timeout, {} requests still in flight".format(self.limiter.in_flight))
+        try:
+            if self.server_type == "waitress":
+                self.server.close()
+            else:
+                self.server.shutdown()
+        except Exception as e:
+            logger.warning("[Server] stop server error: {}".format(e))
@@ -16,7 +16,25 @@ available_setting = {
     "open_ai_api_key": "",  # openai api key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
+    # [可选] 多个api key/接口地址负载均衡，按延迟和剩余额度分配请求，失败的节点会暂时摘除，配置后替代open_ai_api_key和open_ai_api_base
+    # 例如 [{"api_key": "sk-xxx", "api_base": "https://api.openai.com/v1", "weight": 1}, {"api_key": "xxx", "api_base": "https://xxx.openai.azure.com/", "api_type": "azure", "api_version": "2023-06-01-preview", "deployment_id": "gpt-35-turbo"}]
+    "open_ai_endpoints": [],  # api key/接口地址池，每项为请求参数(api_key、api_base、api_type、deployment_id等)和weight，未配置api_type的节点按openai接口请求
+    "endpoint_eject_seconds": 30,  # 节点连续失败或被限流后摘除的秒数，连续摘除时翻倍
     "proxy": "",  # openai使用的代理
+    "http_pool_connections": 10,  # 共享HTTP客户端缓存连接池的host数量
+    "http_pool_maxsize": 20,  # 共享HTTP客户端每个host保持的最大连接数
+    "server_type": "threaded",  # HTTP服务类型，可选 threaded(werkzeug多线程), waitress(需安装waitress)，多进程部署可使用 gunicorn "app:create_app()"
+    "server_threads": 16,  # waitress服务的工作线程数
+    "server_max_concurrency": 64,  # 同时处理的最大请求数，超出后排队，0表示不限制
+    "server_queue_timeout": 5,  # 请求排队等待的最长秒数，超时返回503
+    "server_drain_timeout": 30,  # 收到退出信号后等待处理中请求完成的最长秒数
+    "state_backend": "memory",  # 会话上下文、会话处理锁和消息去重记录的存储，可选 memory(单进程，重启后会话丢失), sqlite(持久化到文件，同一台机器上的多个进程共享)
+    "state_backend_path": "",  # sqlite存储的文件路径，默认为数据目录下的state.db
+    "state_lock_lease_seconds": 300,  # 会话处理锁的租期，处理期间自动续租，持有锁的进程异常退出后最多等待该时长
+    "session_memory_budget": 0,  # 使用sqlite存储时，内存中保留的会话内容总字符数上限，超出后淘汰最久未访问的会话，再次访问时从文件加载，0表示不限制
+    "dedup_capacity": 100000,  # webhook消息去重窗口内预计的消息数量
+    "dedup_error_rate": 0.000001,  # webhook消息去重的误判率，误判的消息会被当作重复消息丢弃
+    "dedup_store_dir": "",  # webhook消息去重的SQLite文件目录，配置后重启不丢失且可多进程共享，为空时使用内存
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 可选择: gpt-4o, pt-4o-mini, gpt-4-turbo, claude-3-sonnet, wenxin, moonshot, qwen-turbo, xunfei, glm-4, minimax, gemini等模型，全部可选模型详见common/const.py文件
     "bot_type": "",  # 可选配置，使用兼容openai格式的三方服务时候，需填"chatGPT"。bot具体名称详见common/const.py文件列出的bot_type，如不填根据model名称判断，
@@ -42,6 +60,10 @@ available_setting = {
     "text_to_image": "dall-e-2",  # 图片生成模型，可选 dall-e-2, dall-e-3
     # Azure OpenAI dall-e-3 配置
     "image_to_text": "zhipuai", # 图片识别模型，可选 zhipuai
+    "image_cache": True,  # 是否缓存下载的图片和图片识别结果，相同图片重复发送、引用或转发时不再重复下载和识别
+    "image_cache_dir": "",  # 图片缓存目录，默认为数据目录下的image_cache
+    "image_cache_max_bytes": 209715200,  # 图片缓存占用磁盘的上限，超出后按最近最少使用淘汰
+    "image_cache_max_descriptions": 1000,  # 内存中缓存的图片识别结果数量
     "dalle3_image_style": "vivid", # 图片生成dalle3的风格，可选有 vivid, natural
     "dalle3_image_quality": "hd", # 图片生成dalle3的质量，可选有 standard, hd
     # Azure OpenAI DALL-E API 配置, 当use_azure_chatgpt为true时,用于将文字回复的资源和Dall-E的资源分开.
@@ -51,16 +73,29 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_max_workers": 8,  # 处理消息的线程池最大线程数，线程按需创建
+    "handler_pool_by_context_type": {},  # 为指定消息类型使用独立线程池，如 {"VOICE": 2, "IMAGE": 2}，避免耗时任务阻塞文本消息
+    "handler_pool_slow_wait_seconds": 10,  # 消息在线程池中排队超过该秒数时打印告警
+    "retry_max_times": 2,  # 请求模型失败时的最大重试次数，仅对限流、超时、服务端错误和网络错误重试
+    "retry_max_delay": 30,  # 单次重试前的最长等待秒数，重试间隔按指数退避并加入随机抖动，服务端返回Retry-After时以其为准
+    "retry_deadline": 60,  # 从第一次请求开始计算，超过该秒数后不再重试
+    "retry_sync_max_wait": 10,  # 同步请求(未开启async_reply)在处理线程中等待重试的总秒数上限，超出后不再重试，避免长时间占用线程
+    "async_reply": False,  # 是否异步请求模型，开启后支持异步的bot(如ChatGPT)在事件循环中等待回复和重试，不占用处理线程，重试等待不受retry_sync_max_wait限制
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "max_sessions": 0,  # 内存中保留的最大会话数，超出后淘汰最久未活跃的会话，0表示不限制
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    "rate_limit_chatgpt_per_session": 0,  # 每个会话每分钟调用chatgpt的次数限制，0表示不限制
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟的token数限制，请求前按会话内容预估token数并预约额度，额度不足时排队，0表示不限制
+    "rate_limit_max_wait": 30,  # 排队等待token额度的最长秒数，超过则直接拒绝请求，避免请求发出后才被服务商限流
+    "rate_limit_completion_tokens": 500,  # 预约额度时预估的回复token数，未设置max_tokens时使用，请求完成后按实际用量调整
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -149,6 +184,10 @@ available_setting = {
     "feishu_app_secret": "",  # 飞书机器人APP secret
     "feishu_token": "",  # 飞书 verification token
     "feishu_bot_name": "",  # 飞书机器人的名字
+    "feishu_hydrate_workers": 4,  # 后台构造飞书消息(获取父消息、下载附件)的线程数，同一用户的消息始终由同一线程处理
+    "feishu_download_concurrency": 4,  # 飞书消息中多个图片附件的并发下载数
+    "feishu_stream_reply": False,  # 是否开启流式回复，开启后回复以消息卡片发送并随生成内容持续更新
+    "feishu_stream_update_interval": 1,  # 流式回复更新卡片的最小间隔，单位秒
     # 钉钉配置
     "dingtalk_client_id": "",  # 钉钉机器人Client ID 
     "dingtalk_client_secret": "",  # 钉钉机器人Client Secret
@@ -163,6 +202,11 @@ available_setting = {
     "appdata_dir": "",  # 数据目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
+    "plugin_slow_threshold": 0,  # 插件处理单个事件超过该秒数时打印告警，0表示不告警，各插件耗时可通过#pstats指令或/plugins/stats接口查看
+    "plugin_stats_token": "",  # /plugins/stats接口的访问令牌，请求需携带Authorization: Bearer <token>头，为空时关闭该接口
+    "plugin_timeout": 0,  # 插件处理单个事件的超时秒数，超时后跳过该插件继续处理，0表示不限制，可在plugins/plugins.json中为单个插件设置timeout
+    "plugin_max_workers": 4,  # 设置了超时的插件在各自独立的线程池中执行，每个插件的最大线程数
+    "plugin_max_overruns": 3,  # 插件连续超时达到该次数后自动关闭，可通过#enablep重新开启，0表示不关闭
     # 是否使用全局插件配置
     "use_global_plugin_config": False,
     "max_media_send_count": 3,  # 单次最大发送媒体资源的个数
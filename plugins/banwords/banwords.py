@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import hashlib
 import json
 import os
 
@@ -9,7 +10,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from .lib.WordsAutomaton import WordsAutomaton
 
 
 @plugins.register(
@@ -35,7 +36,6 @@ class Banwords(Plugin):
                     with open(config_path, "w") as f:
                         json.dump(conf, f, indent=4)
 
-            self.searchr = WordsSearch()
             self.action = conf["action"]
             banwords_path = os.path.join(curdir, "banwords.txt")
             with open(banwords_path, "r", encoding="utf-8") as f:
@@ -44,7 +44,8 @@ class Banwords(Plugin):
                     word = line.strip()
                     if word:
                         words.append(word)
-            self.searchr.SetKeywords(words)
+            self.searchr = self.load_searcher(words, os.path.join(curdir, "banwords.dat"))
+            self.max_word_len = max((len(word) for word in words), default=0)
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
@@ -54,6 +55,27 @@ class Banwords(Plugin):
             logger.warn("[Banwords] init failed, ignore or see https://github.com/zhayujie/chatgpt-on-wechat/tree/master/plugins/banwords .")
             raise e
 
+    def load_searcher(self, words, compiled_path):
+        """
+        词库没有变化时直接加载编译好的自动机，否则重新编译并保存，词库较大时可以节省启动时间
+        """
+        source_hash = hashlib.sha1("\n".join(words).encode("utf-8")).hexdigest()
+        if os.path.exists(compiled_path):
+            try:
+                searcher = WordsAutomaton.load(compiled_path, source_hash)
+                if searcher:
+                    logger.info("[Banwords] load compiled banwords from {}".format(compiled_path))
+                    return searcher
+            except Exception as e:
+                logger.warn("[Banwords] load compiled banwords failed: {}".format(e))
+        searcher = WordsAutomaton()
+        searcher.SetKeywords(words)
+        try:
+            searcher.save(compiled_path, source_hash)
+        except Exception as e:
+            logger.warn("[Banwords] save compiled banwords failed: {}".format(e))
+        return searcher
+
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type not in [
             ContextType.TEXT,
@@ -77,10 +99,14 @@ class Banwords(Plugin):
                 return
 
     def on_decorate_reply(self, e_context: EventContext):
-        if e_context["reply"].type not in [ReplyType.TEXT]:
+        reply = e_context["reply"]
+        if reply.type == ReplyType.STREAM:
+            # 流式回复无法等全部内容生成后再检查，在内容发出前逐块过滤
+            reply.content = self.filter_stream(reply.content, self.reply_action)
+            return
+        if reply.type not in [ReplyType.TEXT]:
             return
 
-        reply = e_context["reply"]
         content = reply.content
         if self.reply_action == "ignore":
             f = self.searchr.FindFirst(content)
@@ -96,5 +122,49 @@ class Banwords(Plugin):
                 e_context.action = EventAction.CONTINUE
                 return
 
+    def filter_stream(self, chunks, action):
+        """
+        按块过滤流式回复，末尾可能与后续内容组成敏感词的字符暂不发出，与下一块合并后再检查
+        ignore: 发现敏感词后停止输出，已发出的内容无法撤回
+        replace: 将敏感词替换为*后输出，输出结束后追加与文本回复相同的替换提示
+        """
+        hold = max(self.max_word_len - 1, 0)
+        buffer = ""
+        masked = 0  # buffer开头已被之前的敏感词覆盖、需要保持替换的字符数
+        replaced_any = False
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) <= hold:
+                continue
+            cut = len(buffer) - hold
+            if action == "ignore":
+                f = self.searchr.FindFirst(buffer)
+                if f:
+                    logger.info("[Banwords] %s in stream reply" % f["Keyword"])
+                    return
+                out = buffer[:cut]
+            else:
+                replaced = self.searchr.Replace(buffer)
+                replaced_any = replaced_any or replaced != buffer
+                replaced = "*" * masked + replaced[masked:]
+                out = replaced[:cut]
+                tail = replaced[cut:]
+                masked = len(tail) - len(tail.lstrip("*"))
+            buffer = buffer[cut:]
+            yield out
+        if buffer:
+            if action == "ignore":
+                f = self.searchr.FindFirst(buffer)
+                if f:
+                    logger.info("[Banwords] %s in stream reply" % f["Keyword"])
+                    return
+                yield buffer
+            else:
+                replaced = self.searchr.Replace(buffer)
+                replaced_any = replaced_any or replaced != buffer
+                yield "*" * masked + replaced[masked:]
+        if replaced_any:
+            yield "\n\n已替换回复中的敏感词"
+
     def get_help_text(self, **kwargs):
         return "过滤消息中的敏感词。"
@@ -0,0 +1,299 @@
+# encoding:utf-8
+"""
+基于双数组trie的Aho-Corasick自动机，接口与WordsSearch一致，可直接替换
+- 字符先映射为稠密编码，不在任何敏感词中的字符直接回到根节点
+- 转移、失败指针和匹配结果保存在array中，扫描时只有数组下标访问，没有节点对象和方法调用
+- 编译结果可以保存到文件，词库不变时启动直接加载，无需重新构建
+"""
+
+import json
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"BWAC"
+VERSION = 1
+
+
+class WordsAutomaton:
+    def __init__(self):
+        self._keywords = []
+        self._codes = {}  # 字符 -> 编码，编码从1开始
+        self._base = array("i", [1])
+        self._check = array("i", [-1])
+        self._fail = array("i", [0])
+        self._output = array("i", [-1])  # 以该状态结尾的敏感词编号，-1表示没有
+        self._match = array("i", [-1])  # 以该状态结尾的最长敏感词编号，包含失败指针上的敏感词
+        self._root_next = array("i", [0])  # 根节点按编码的转移，没有时为0(根节点)
+        self._duplicates = {}  # 重复出现的敏感词，第一次出现的编号 -> 之后出现的编号列表
+
+    def SetKeywords(self, keywords):
+        self._keywords = list(keywords)
+        # 出现次数多的字符编码小，数组更紧凑
+        freq = {}
+        for word in self._keywords:
+            for ch in word:
+                freq[ch] = freq.get(ch, 0) + 1
+        chars = sorted(freq, key=lambda ch: -freq[ch])
+        self._codes = {ch: i + 1 for i, ch in enumerate(chars)}
+        self._init_duplicates()
+        self._build(self._trie())
+
+    def _init_duplicates(self):
+        # trie中每个节点只记录第一次出现的编号，FindAll与WordsSearch一样需要返回重复敏感词的每个编号
+        first = {}
+        self._duplicates = {}
+        for i, word in enumerate(self._keywords):
+            if word in first:
+                self._duplicates.setdefault(first[word], []).append(i)
+            else:
+                first[word] = i
+
+    def _trie(self):
+        """
+        构建普通trie，返回每个节点的子节点字典和以该节点结尾的敏感词编号
+        """
+        children = [{}]
+        output = [-1]
+        for i, word in enumerate(self._keywords):
+            node = 0
+            for ch in word:
+                code = self._codes[ch]
+                child = children[node].get(code)
+                if child is None:
+                    child = len(children)
+                    children[node][code] = child
+                    children.append({})
+                    output.append(-1)
+                node = child
+            if output[node] < 0:
+                output[node] = i
+        return children, output
+
+    def _build(self, trie):
+        children, node_output = trie
+        max_code = len(self._codes)
+        base = [0]
+        check = [-1]
+        next_free = [1]  # 并查集，查找不小于某个位置的第一个空闲位置，被占用的位置指向下一个位置
+        position = [0] * len(children)  # trie节点 -> 双数组中的状态
+
+        def ensure(size):
+            if size > len(check):
+                grow = size - len(check)
+                next_free.extend(range(len(check), size))
+                base.extend([0] * grow)
+                check.extend([-1] * grow)
+
+        def find_free(p):
+            ensure(p + 1)
+            root = p
+            while next_free[root] != root:
+                root = next_free[root]
+                ensure(root + 1)
+            while next_free[p] != root:
+                next_free[p], p = root, next_free[p]
+            return root
+
+        # 按层遍历，为每个节点找到能放下全部子节点的base，只在空闲位置中查找
+        # 前面的空闲位置零散，多个子节点的节点很难放下，查找多次失败后此类节点从更靠后的位置开始找
+        min_base = 1
+        queue = [0]
+        for node in queue:
+            codes = sorted(children[node])
+            if not codes:
+                continue
+            lower = min_base if len(codes) > 1 else 1
+            p = find_free(lower + codes[0])
+            tries = 0
+            while True:
+                b = p - codes[0]
+                ensure(b + codes[-1] + 1)
+                if all(check[b + code] < 0 for code in codes):
+                    break
+                p = find_free(p + 1)
+                tries += 1
+            if tries > 16:
+                min_base = max(min_base, b)
+            state = position[node]
+            base[state] = b
+            for code in codes:
+                check[b + code] = state
+                next_free[b + code] = b + code + 1
+                position[children[node][code]] = b + code
+                queue.append(children[node][code])
+
+        # 补齐长度，任意状态加上任意编码都不会越界
+        ensure(max(base) + max_code + 1)
+        size = len(check)
+        fail = [0] * size
+        output = [-1] * size
+        match = [-1] * size
+        # queue是按层的顺序，计算失败指针时父节点和更浅的节点都已处理
+        for node in queue:
+            state = position[node]
+            output[state] = node_output[node]
+            match[state] = output[state] if output[state] >= 0 else match[fail[state]]
+            for code, child in children[node].items():
+                child_state = position[child]
+                if node == 0:
+                    fail[child_state] = 0
+                    continue
+                f = fail[state]
+                while True:
+                    t = base[f] + code
+                    if check[t] == f:
+                        fail[child_state] = t
+                        break
+                    if f == 0:
+                        fail[child_state] = 0
+                        break
+                    f = fail[f]
+        self._base = array("i", base)
+        self._check = array("i", check)
+        self._fail = array("i", fail)
+        self._output = array("i", output)
+        self._match = array("i", match)
+        self._init_root_next()
+
+    def _init_root_next(self):
+        base, check = self._base, self._check
+        self._root_next = array("i", (base[0] + code if check[base[0] + code] == 0 else 0 for code in range(len(self._codes) + 1)))
+
+    def _scan(self, text):
+        """
+        扫描文本，yield (结束位置, 以该位置结尾的最长敏感词编号, 状态)
+        """
+        base = self._base
+        check = self._check
+        fail = self._fail
+        match = self._match
+        root_next = self._root_next
+        state = 0
+        # 字符编码的查找在map中完成，减少每个字符的字节码
+        for i, code in enumerate(map(self._codes.get, text)):
+            if code is None:
+                state = 0
+                continue
+            while state:
+                t = base[state] + code
+                if check[t] == state:
+                    state = t
+                    break
+                state = fail[state]
+            else:
+                state = root_next[code]
+            if match[state] >= 0:
+                yield i, match[state], state
+
+    def _result(self, item, end):
+        keyword = self._keywords[item]
+        return {"Keyword": keyword, "Success": True, "End": end, "Start": end + 1 - len(keyword), "Index": item}
+
+    def FindFirst(self, text):
+        for end, item, _ in self._scan(text):
+            return self._result(item, end)
+        return None
+
+    def FindAll(self, text):
+        results = []
+        output = self._output
+        fail = self._fail
+        duplicates = self._duplicates
+        for end, _, state in self._scan(text):
+            # 沿失败指针依次取出以该位置结尾的所有敏感词，从长到短
+            while state:
+                item = output[state]
+                if item >= 0:
+                    results.append(self._result(item, end))
+                    for duplicate in duplicates.get(item, ()):
+                        results.append(self._result(duplicate, end))
+                state = fail[state]
+        return results
+
+    def ContainsAny(self, text):
+        for _ in self._scan(text):
+            return True
+        return False
+
+    def Replace(self, text, replaceChar="*"):
+        """
+        一次扫描替换所有敏感词，重叠的敏感词合并为一段
+        """
+        spans = []  # 待替换的区间[start, end)，互不重叠且按位置递增
+        keywords = self._keywords
+        for end, item, _ in self._scan(text):
+            start = end + 1 - len(keywords[item])
+            # 较长的敏感词可能覆盖之前的多个区间
+            while spans and start <= spans[-1][1]:
+                start = min(start, spans.pop()[0])
+            spans.append((start, end + 1))
+        if not spans:
+            return text
+        parts = []
+        last = 0
+        for start, end in spans:
+            parts.append(text[last:start])
+            parts.append(replaceChar * (end - start))
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+    def save(self, path, source_hash=""):
+        """
+        保存编译结果，source_hash用于加载时判断词库是否有变化
+        """
+        chars = [""] * len(self._codes)
+        for ch, code in self._codes.items():
+            chars[code - 1] = ch
+        header = {
+            "version": VERSION,
+            "source_hash": source_hash,
+            "byteorder": sys.byteorder,
+            "size": len(self._check),
+            "chars": "".join(chars),
+            "keywords": self._keywords,
+        }
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        # 先写入临时文件再替换，写入中途退出或多个进程同时保存时不会留下不完整的文件
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(MAGIC)
+                f.write(struct.pack("<I", len(header_bytes)))
+                f.write(header_bytes)
+                for arr in (self._base, self._check, self._fail, self._output, self._match):
+                    arr.tofile(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, source_hash=None):
+        """
+        加载编译结果，文件格式不符或source_hash不一致时返回None
+        """
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (header_size,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_size).decode("utf-8"))
+            if header.get("version") != VERSION or (source_hash is not None and header.get("source_hash") != source_hash):
+                return None
+            arrays = []
+            for _ in range(5):
+                arr = array("i")
+                arr.fromfile(f, header["size"])
+                if header["byteorder"] != sys.byteorder:
+                    arr.byteswap()
+                arrays.append(arr)
+        automaton = cls()
+        automaton._keywords = header["keywords"]
+        automaton._codes = {ch: i + 1 for i, ch in enumerate(header["chars"])}
+        automaton._base, automaton._check, automaton._fail, automaton._output, automaton._match = arrays
+        automaton._init_root_next()
+        automaton._init_duplicates()
+        return automaton
@@ -24,6 +24,7 @@ from plugins import *
     desc="Baidu unit bot system",
     version="0.1",
     author="jackson",
+    content_types=[ContextType.TEXT],
 )
 class BDunit(Plugin):
     def __init__(self):
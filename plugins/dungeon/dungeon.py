@@ -48,6 +48,7 @@ class StoryTeller:
     desc="A plugin to play dungeon game",
     version="1.0",
     author="lanvent",
+    content_types=[ContextType.TEXT],
 )
 class Dungeon(Plugin):
     def __init__(self):
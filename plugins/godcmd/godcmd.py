@@ -12,7 +12,7 @@ import plugins
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from common import const
+from common import const, worker_pool
 from config import conf, load_config, global_config
 from plugins import *
 
@@ -131,6 +131,15 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pool": {
+        "alias": ["pool", "线程池"],
+        "desc": "查看消息处理线程池状态",
+    },
+    "pstats": {
+        "alias": ["pstats", "插件耗时"],
+        "args": ["[reset]"],
+        "desc": "查看各插件处理事件的次数、耗时和异常，reset清空统计",
+    },
 }
 
 
@@ -352,6 +361,20 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pool":
+                            ok = True
+                            result = "线程池状态：\n"
+                            for stats in worker_pool.pool_stats():
+                                result += "{name}: 线程 {threads}/{max_workers}, 执行中 {active}, 排队 {pending}, 平均等待 {avg_wait}s, 最长等待 {max_wait}s\n".format(**stats)
+                        elif cmd == "pstats":
+                            ok = True
+                            if args and args[0] == "reset":
+                                PluginManager().stats.reset()
+                                result = "插件统计已清空"
+                            else:
+                                result = "插件耗时统计：\n"
+                                for stats in PluginManager().stats.stats():
+                                    result += "{plugin} {event}: 调用 {calls}, p50 {p50_ms}ms, p99 {p99_ms}ms, 最长 {max_ms}ms, 异常 {errors}, 中断 {breaks}, 超时 {timeouts}\n".format(**stats)
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -16,6 +16,7 @@ from config import conf
     desc="A simple plugin that says hello",
     version="0.1",
     author="lanvent",
+    content_types=[ContextType.TEXT, ContextType.JOIN_GROUP, ContextType.PATPAT, ContextType.EXIT_GROUP],
 )
 
 
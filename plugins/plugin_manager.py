@@ -1,17 +1,23 @@
 # encoding:utf-8
 
+import concurrent.futures
 import importlib
 import importlib.util
 import json
 import os
 import sys
+import time
 
+from bridge.context import Context
+from bridge.reply import Reply
+from common import worker_pool
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
 from config import conf, remove_plugin_config, write_plugin_config
 
 from .event import *
+from .plugin_stats import PluginStats
 
 
 @singleton
@@ -19,7 +25,10 @@ class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        self.dispatch_table = {}  # 每个事件预先生成的处理链，元素为(插件名, 处理函数, 关注的消息类型, 超时秒数)
+        self.overruns = {}  # 插件连续超时的次数
         self.instances = {}
+        self.stats = PluginStats()
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
@@ -34,6 +43,10 @@ class PluginManager:
             plugincls.version = kwargs.get("version") if kwargs.get("version") != None else "1.0"
             plugincls.namecn = kwargs.get("namecn") if kwargs.get("namecn") != None else name
             plugincls.hidden = kwargs.get("hidden") if kwargs.get("hidden") != None else False
+            # 插件关注的消息类型(ContextType)列表，不为空时其他类型的消息不会调用该插件
+            plugincls.content_types = frozenset(kwargs["content_types"]) if kwargs.get("content_types") else None
+            # 插件处理单个事件的超时秒数，为None时使用全局的plugin_timeout，可在plugins.json中覆盖
+            plugincls.timeout = kwargs.get("timeout")
             plugincls.enabled = True
             if self.current_plugin_path == None:
                 raise Exception("Plugin path not set")
@@ -128,6 +141,8 @@ class PluginManager:
             else:
                 self.plugins[name].enabled = pconf["plugins"][rawname]["enabled"]
                 self.plugins[name].priority = pconf["plugins"][rawname]["priority"]
+                if "timeout" in pconf["plugins"][rawname]:
+                    self.plugins[name].timeout = pconf["plugins"][rawname]["timeout"]
                 self.plugins._update_heap(name)  # 更新下plugins中的顺序
         if modified:
             self.save_config()
@@ -136,6 +151,28 @@ class PluginManager:
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self.build_dispatch_table()
+
+    def build_dispatch_table(self):
+        """
+        预先生成每个事件的处理链，只包含已开启的插件，插件开启、关闭、重载和调整优先级时重新生成
+        emit_event直接遍历处理链，无需逐个查询插件状态
+        """
+        dispatch_table = {}
+        for event, names in self.listening_plugins.items():
+            chain = []
+            for name in names:
+                plugincls = self.plugins.get(name)
+                instance = self.instances.get(name)
+                if plugincls is None or not plugincls.enabled or instance is None or event not in instance.handlers:
+                    continue
+                timeout = getattr(plugincls, "timeout", None)
+                if name == "GODCMD" or plugincls.priority >= 999:
+                    timeout = 0  # 管理命令插件始终同步执行，不受超时限制，也不会被自动关闭
+                chain.append((name, instance.handlers[event], getattr(plugincls, "content_types", None), timeout))
+            dispatch_table[event] = tuple(chain)
+        # 整体替换，处理中的事件继续使用旧的处理链
+        self.dispatch_table = dispatch_table
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -157,7 +194,8 @@ class PluginManager:
                 for event in instance.handlers:
                     if event not in self.listening_plugins:
                         self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
+                    if name not in self.listening_plugins[event]:
+                        self.listening_plugins[event].append(name)
         self.refresh_order()
         return failed_plugins
 
@@ -188,17 +226,92 @@ class PluginManager:
         self.activate_plugins()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        chain = self.dispatch_table.get(e_context.event)
+        if not chain or e_context.action != EventAction.CONTINUE:
+            return e_context
+        default_timeout = conf().get("plugin_timeout", 0)
+        for name, handler, content_types, timeout in chain:
+            if content_types is not None:
+                # 前面的插件可能修改了消息类型，每次按当前的类型判断
+                context = e_context.econtext.get("context")
+                if context is None or context.type not in content_types:
+                    continue
+            logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+            started_at = time.perf_counter()
+            try:
+                finished = self._call_handler(name, handler, default_timeout if timeout is None else timeout, e_context, *args, **kwargs)
+            except Exception:
+                self.stats.record(name, e_context.event, time.perf_counter() - started_at, error=True)
+                raise
+            if not finished:
+                self.stats.record(name, e_context.event, time.perf_counter() - started_at, timeout=True)
+                self._on_overrun(name, e_context.event)
+                continue
+            self.overruns.pop(name, None)
+            breaked = e_context.is_break()
+            self.stats.record(name, e_context.event, time.perf_counter() - started_at, breaked=breaked)
+            if breaked:
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s", name, e_context.event)
+                break
         return e_context
 
+    def _call_handler(self, name, handler, timeout, e_context: EventContext, *args, **kwargs) -> bool:
+        """
+        调用插件的事件处理函数，设置了超时时间时在插件独立的线程池中执行
+        处理函数修改的是事件上下文的副本，按时完成才写回，超时后继续执行也不会影响后续插件
+        :return: 超时返回False
+        """
+        if not timeout:
+            handler(e_context, *args, **kwargs)
+            return True
+        # context和reply可能被处理函数就地修改，需要复制一份，channel等其他对象共用
+        originals = {}
+        econtext = dict(e_context.econtext)
+        for key, value in econtext.items():
+            if isinstance(value, (Context, Reply)):
+                copied = object.__new__(type(value))
+                copied.__dict__.update(value.__dict__)
+                if isinstance(value, Context):
+                    copied.kwargs = dict(value.kwargs)
+                econtext[key] = copied
+                originals[key] = (value, copied)
+        isolated = EventContext(e_context.event, econtext)
+        isolated.action = e_context.action
+        pool = worker_pool.get_pool("plugin_" + name.lower(), conf().get("plugin_max_workers", 4))
+        future = pool.submit(handler, isolated, *args, **kwargs)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if not future.done():  # 区分处理函数自身抛出的TimeoutError
+                future.cancel()
+                return False
+            raise
+        # 按时完成后写回，原对象可能被调用方引用，就地更新而不是替换
+        for key, (value, copied) in originals.items():
+            if isolated.econtext.get(key) is copied:
+                value.__dict__.update(copied.__dict__)
+                isolated.econtext[key] = value
+        e_context.econtext.clear()
+        e_context.econtext.update(isolated.econtext)
+        e_context.action = isolated.action
+        return True
+
+    def _on_overrun(self, name, event):
+        """
+        插件处理超时，跳过该插件继续处理事件，连续超时次数过多时暂时关闭插件，可通过#enablep重新开启
+        自动关闭只在本次运行中生效，不写入plugins.json，重启后插件按配置重新开启
+        """
+        count = self.overruns.get(name, 0) + 1
+        self.overruns[name] = count
+        logger.warn("[PluginManager] plugin {} timed out handling {}, overruns={}".format(name, event.name, count))
+        max_overruns = conf().get("plugin_max_overruns", 3)
+        if max_overruns and count >= max_overruns and self.plugins[name].enabled:
+            logger.error("[PluginManager] plugin {} timed out {} times in a row, disabled until restart or #enablep".format(name, count))
+            self.plugins[name].enabled = False
+            self.overruns.pop(name, None)
+            self.build_dispatch_table()
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -238,6 +351,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.build_dispatch_table()
             return True
         return True
 
@@ -336,6 +450,7 @@ class PluginManager:
                 if name in self.listening_plugins[event]:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
+            self.build_dispatch_table()
             del self.pconf["plugins"][rawname]
             self.loaded[dirname] = None
             self.save_config()
@@ -0,0 +1,84 @@
+# encoding:utf-8
+
+import threading
+from collections import deque
+
+from common.log import logger
+from config import conf
+
+
+class HandlerStats:
+    def __init__(self, window):
+        self.calls = 0
+        self.errors = 0
+        self.breaks = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.durations = deque(maxlen=window)  # 最近的耗时，用于计算分位数
+
+
+class PluginStats:
+    """
+    记录每个插件处理每种事件的调用次数、耗时分位数、异常和中断次数
+    :param window: 计算分位数时使用最近多少次调用的耗时
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.handlers = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, event, duration, error=False, breaked=False, timeout=False):
+        key = (name, event)
+        with self.lock:
+            stats = self.handlers.get(key)
+            if stats is None:
+                stats = self.handlers[key] = HandlerStats(self.window)
+            stats.calls += 1
+            stats.errors += error
+            stats.breaks += breaked
+            stats.timeouts += timeout
+            stats.total_time += duration
+            stats.max_time = max(stats.max_time, duration)
+            stats.durations.append(duration)
+        slow_threshold = conf().get("plugin_slow_threshold", 0)
+        if slow_threshold and duration > slow_threshold:
+            logger.warn("[PluginStats] plugin {} handled {} slowly, cost {:.2f}s".format(name, event.name, duration))
+
+    @staticmethod
+    def _percentile(durations, percent):
+        if not durations:
+            return 0.0
+        return durations[min(len(durations) - 1, int(len(durations) * percent / 100))]
+
+    def stats(self) -> list:
+        """
+        :return: 按总耗时倒序排列的统计列表，耗时单位为毫秒
+        """
+        result = []
+        with self.lock:
+            for (name, event), stats in self.handlers.items():
+                durations = sorted(stats.durations)
+                result.append(
+                    {
+                        "plugin": name,
+                        "event": event.name,
+                        "calls": stats.calls,
+                        "errors": stats.errors,
+                        "breaks": stats.breaks,
+                        "timeouts": stats.timeouts,
+                        "error_rate": round(stats.errors / stats.calls, 4),
+                        "break_rate": round(stats.breaks / stats.calls, 4),
+                        "total_ms": round(stats.total_time * 1000, 1),
+                        "p50_ms": round(self._percentile(durations, 50) * 1000, 1),
+                        "p99_ms": round(self._percentile(durations, 99) * 1000, 1),
+                        "max_ms": round(stats.max_time * 1000, 1),
+                    }
+                )
+        result.sort(key=lambda item: item["total_ms"], reverse=True)
+        return result
+
+    def reset(self):
+        with self.lock:
+            self.handlers.clear()
@@ -39,6 +39,7 @@ class RolePlay:
     desc="为你的Bot设置预设角色",
     version="1.0",
     author="lanvent",
+    content_types=[ContextType.TEXT],
 )
 class Role(Plugin):
     def __init__(self):
@@ -0,0 +1,83 @@
+# encoding:utf-8
+"""
+敏感词匹配性能测试，对比WordsSearch和WordsAutomaton的构建、加载和匹配耗时，并校验两者结果一致
+用法: python3 scripts/bench_banwords.py [词库文件] [文本长度]
+未指定词库文件时随机生成30000个敏感词
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "banwords", "lib"))
+
+from WordsAutomaton import WordsAutomaton  # noqa: E402
+from WordsSearch import WordsSearch  # noqa: E402
+
+
+def load_words(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def random_words(count, chars):
+    words = set()
+    while len(words) < count:
+        words.add("".join(random.choice(chars) for _ in range(random.randint(2, 6))))
+    return list(words)
+
+
+def timeit(func, rounds):
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        result = func()
+    return (time.perf_counter() - started_at) / rounds, result
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    words = load_words(sys.argv[1]) if len(sys.argv) > 1 else random_words(30000, chars)
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    # 模拟较长的回复，其中混入少量敏感词
+    plain = "".join(random.choice(chars + list("，。 ")) for _ in range(length))
+    text = "".join(plain[i : i + 200] + random.choice(words) for i in range(0, len(plain), 200))
+    print("keywords: {}, text length: {}".format(len(words), len(text)))
+
+    started_at = time.perf_counter()
+    old = WordsSearch()
+    old.SetKeywords(words)
+    print("{:<16} {:>10.3f}s".format("WordsSearch build", time.perf_counter() - started_at))
+
+    started_at = time.perf_counter()
+    new = WordsAutomaton()
+    new.SetKeywords(words)
+    print("{:<16} {:>10.3f}s".format("WordsAutomaton build", time.perf_counter() - started_at))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "banwords.dat")
+        new.save(path)
+        cost, loaded = timeit(lambda: WordsAutomaton.load(path), 5)
+        print("{:<16} {:>10.3f}s, {} bytes".format("WordsAutomaton load", cost, os.path.getsize(path)))
+
+    # 不含敏感词的文本需要扫描全文
+    clean = new.Replace(plain)
+    cases = [
+        ("ContainsAny(clean)", lambda s: s.ContainsAny(clean)),
+        ("FindFirst", lambda s: s.FindFirst(text)),
+        ("FindAll", lambda s: s.FindAll(text)),
+        ("Replace", lambda s: s.Replace(text)),
+    ]
+    print("{:<20} {:>14} {:>14} {:>8}".format("", "WordsSearch", "WordsAutomaton", "speedup"))
+    for name, func in cases:
+        old_cost, old_result = timeit(lambda: func(old), 20)
+        new_cost, new_result = timeit(lambda: func(new), 20)
+        loaded_result = func(loaded)
+        if name == "FindAll":
+            old_result = sorted((r["End"], r["Keyword"]) for r in old_result)
+            new_result = sorted((r["End"], r["Keyword"]) for r in new_result)
+            loaded_result = sorted((r["End"], r["Keyword"]) for r in loaded_result)
+        assert old_result == new_result == loaded_result, name
+        print("{:<20} {:>12.2f}ms {:>12.2f}ms {:>7.1f}x".format(name, old_cost * 1000, new_cost * 1000, old_cost / new_cost))
@@ -0,0 +1,61 @@
+# encoding:utf-8
+"""
+SortedDict性能测试，模拟插件管理中的注册、调整优先级、遍历和卸载
+用法: python3 scripts/bench_sorted_dict.py [插件数量...]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.sorted_dict import SortedDict  # noqa: E402
+
+
+class FakePlugin:
+    def __init__(self, priority):
+        self.priority = priority
+
+
+def bench(n, rounds=1000):
+    random.seed(n)
+    names = ["PLUGIN_{}".format(i) for i in range(n)]
+    result = {}
+
+    started_at = time.perf_counter()
+    plugins = SortedDict(lambda k, v: v.priority, reverse=True)
+    for name in names:
+        plugins[name] = FakePlugin(random.randint(-1000, 1000))
+    result["register"] = (time.perf_counter() - started_at) / n
+
+    # 调整优先级后立即按顺序遍历，对应set_plugin_priority后处理消息
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        name = random.choice(names)
+        plugins[name].priority = random.randint(-1000, 1000)
+        plugins._update_heap(name)
+        for _ in plugins.items():
+            break
+    result["setpri+iter"] = (time.perf_counter() - started_at) / rounds
+
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        for _ in plugins.items():
+            pass
+    result["iter(cached)"] = (time.perf_counter() - started_at) / rounds
+
+    started_at = time.perf_counter()
+    for name in names[: min(n, rounds)]:
+        del plugins[name]
+    result["uninstall"] = (time.perf_counter() - started_at) / min(n, rounds)
+    return result
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 10000]
+    print("{:>8} {:>14} {:>14} {:>14} {:>14}".format("n", "register", "setpri+iter", "iter(cached)", "uninstall"))
+    for n in sizes:
+        result = bench(n)
+        print("{:>8} {:>12.2f}us {:>12.2f}us {:>12.2f}us {:>12.2f}us".format(n, *(v * 1e6 for v in result.values())))
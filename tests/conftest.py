@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+from common import dedup, endpoint_pool, expired_dict, retry, state_backend, token_bucket
+
+
+class FakeClock:
+    """
+    手动推进的时钟，monotonic和time返回同一个时间，其余函数仍使用真实的time模块
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    只替换被测模块自己引用的time，不修改全局的time模块，其他模块和后台线程不受影响
+    """
+    clock = FakeClock()
+    for module in (dedup, endpoint_pool, retry, state_backend, token_bucket):
+        monkeypatch.setattr(module, "time", clock)
+    monkeypatch.setattr(expired_dict, "_monotonic", clock)
+    return clock
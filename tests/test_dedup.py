@@ -0,0 +1,45 @@
+import os
+
+from common.dedup import BloomDedupStore, SqliteDedupStore
+
+
+def test_bloom_hits_within_window(clock):
+    store = BloomDedupStore(60, 1000, 0.0001)
+    assert not store.seen("msg1")
+    assert store.seen("msg1")
+    assert not store.seen("msg2")
+
+
+def test_bloom_keeps_keys_for_one_rotation(clock):
+    store = BloomDedupStore(60, 1000, 0.0001)
+    store.seen("msg1")
+    clock.now += 61  # 轮换后上一个过滤器仍然有效
+    assert store.seen("msg1")
+    clock.now += 121  # 超过两个周期后全部过期
+    assert not store.seen("msg1")
+
+
+def test_sqlite_hits_across_restarts(clock, tmp_path):
+    path = os.path.join(str(tmp_path), "dedup.db")
+    store = SqliteDedupStore(60, path)
+    assert not store.seen("msg1")
+    store.conn.close()
+    restarted = SqliteDedupStore(60, path)
+    assert restarted.seen("msg1")
+    assert not restarted.seen("msg2")
+
+
+def test_sqlite_key_expires_after_window(clock, tmp_path):
+    store = SqliteDedupStore(60, os.path.join(str(tmp_path), "dedup.db"))
+    store.seen("msg1")
+    clock.now += 61
+    assert not store.seen("msg1")
+    assert store.seen("msg1")
+
+
+def test_sqlite_shared_between_instances(clock, tmp_path):
+    path = os.path.join(str(tmp_path), "dedup.db")
+    first = SqliteDedupStore(60, path)
+    second = SqliteDedupStore(60, path)
+    assert not first.seen("msg1")
+    assert second.seen("msg1")
@@ -0,0 +1,74 @@
+from common.endpoint_pool import Endpoint, EndpointPool
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None):
+        super().__init__("rate limited")
+        self.headers = headers
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+def make_pool(**kwargs):
+    return EndpointPool([Endpoint("a", {"api_key": "a"}), Endpoint("b", {"api_key": "b"})], **kwargs)
+
+
+def test_acquire_and_release_track_inflight(clock):
+    pool = make_pool()
+    endpoint = pool.acquire()
+    assert endpoint.inflight == 1
+    pool.release(endpoint, latency=0.5)
+    assert endpoint.inflight == 0
+    assert endpoint.latency == 0.5
+
+
+def test_rate_limited_endpoint_is_ejected_for_retry_after(clock):
+    pool = make_pool()
+    a, b = pool.endpoints
+    pool.acquire()
+    pool.release(a, 0.1, RateLimitError({"retry-after": "20"}))
+    assert a.ejected_until == clock.now + 20
+    assert all(pool.acquire() is b for _ in range(20))
+    clock.now += 21
+    assert a in {pool.acquire() for _ in range(200)}
+
+
+def test_repeated_failures_eject_with_backoff(clock):
+    pool = make_pool(eject_seconds=10, failure_threshold=2)
+    a = pool.endpoints[0]
+    for _ in range(2):
+        pool.release(a, 0.1, APIConnectionError())
+    assert a.ejected_until == clock.now + 10
+    for _ in range(2):
+        pool.release(a, 0.1, APIConnectionError())
+    assert a.ejected_until == clock.now + 20
+    pool.release(a, 0.1)
+    assert a.ejections == 0
+
+
+def test_unrelated_errors_do_not_eject(clock):
+    pool = make_pool(failure_threshold=1)
+    a = pool.endpoints[0]
+    pool.release(a, 0.1, ValueError("bad request"))
+    assert a.ejected_until == 0
+
+
+def test_all_ejected_picks_earliest_recovery(clock):
+    pool = make_pool()
+    a, b = pool.endpoints
+    pool.release(a, 0.1, RateLimitError({"retry-after": "30"}))
+    pool.release(b, 0.1, RateLimitError({"retry-after": "10"}))
+    assert pool.acquire() is b
+
+
+def test_remaining_from_headers():
+    headers = {
+        "x-ratelimit-remaining-requests": "50",
+        "x-ratelimit-limit-requests": "100",
+        "x-ratelimit-remaining-tokens": "1000",
+        "x-ratelimit-limit-tokens": "10000",
+    }
+    assert EndpointPool.remaining_from_headers(headers) == 0.1
+    assert EndpointPool.remaining_from_headers({}) is None
@@ -0,0 +1,94 @@
+import copy
+import pickle
+import threading
+
+import pytest
+
+from common.expired_dict import ExpiredDict
+
+
+def test_key_expires_after_ttl(clock):
+    d = ExpiredDict(10, sweep_interval=None)
+    d["a"] = 1
+    clock.now += 5
+    assert d["a"] == 1
+    clock.now += 11
+    assert "a" not in d
+    with pytest.raises(KeyError):
+        d["a"]
+
+
+def test_access_refreshes_ttl(clock):
+    d = ExpiredDict(10, sweep_interval=None)
+    d["a"] = 1
+    for _ in range(3):
+        clock.now += 8
+        assert d.get("a") == 1
+    assert len(d) == 1
+
+
+def test_lru_eviction_on_max_size(clock):
+    evicted = []
+    d = ExpiredDict(100, max_size=2, on_evict=lambda k, v: evicted.append(k), sweep_interval=None)
+    d["a"] = 1
+    d["b"] = 2
+    d["a"]  # a变为最近访问，超出容量时淘汰b
+    d["c"] = 3
+    assert evicted == ["b"]
+    assert d.keys() == ["a", "c"]
+
+
+def test_sweep_evicts_expired_keys_in_order(clock):
+    evicted = []
+    d = ExpiredDict(10, on_evict=lambda k, v: evicted.append(k), sweep_interval=None)
+    d["a"] = 1
+    clock.now += 5
+    d["b"] = 2
+    clock.now += 6
+    d.sweep()
+    assert evicted == ["a"]
+    assert d.keys() == ["b"]
+
+
+def test_delete_does_not_call_on_evict(clock):
+    evicted = []
+    d = ExpiredDict(10, on_evict=lambda k, v: evicted.append(k), sweep_interval=None)
+    d["a"] = 1
+    assert d.pop("a") == 1
+    del_missing = d.pop("a", None)
+    assert del_missing is None
+    assert evicted == []
+
+
+def test_on_evict_runs_after_lock_released(clock):
+    d = ExpiredDict(10, max_size=1, sweep_interval=None)
+    blocked = []
+
+    def on_evict(key, value):
+        # 其他线程在回调中访问字典不能被阻塞
+        t = threading.Thread(target=d.get, args=("b",))
+        t.start()
+        t.join(1)
+        blocked.append(t.is_alive())
+
+    d.on_evict = on_evict
+    d["a"] = 1
+    d["b"] = 2
+    assert blocked == [False]
+
+
+def test_copy_and_pickle(clock):
+    d = ExpiredDict(10, max_size=5, sweep_interval=None)
+    d["a"] = 1
+    clock.now += 5
+    d["b"] = 2
+    c = d.copy()
+    assert isinstance(c, ExpiredDict) and c.max_size == 5
+    assert c.items() == [("a", 1), ("b", 2)]
+    clock.now += 6  # 复制后剩余有效期不变
+    assert c.keys() == ["b"]
+    assert copy.copy(d).keys() == ["b"]
+
+    p = pickle.loads(pickle.dumps(d))
+    assert p.items() == [("b", 2)]
+    assert p.expires_in_seconds == 10 and p.max_size == 5
@@ -0,0 +1,74 @@
+import pytest
+
+from common import retry
+from common.retry import RetryPolicy
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None):
+        super().__init__("rate limited")
+        self.headers = headers
+
+
+class APIError(Exception):
+    def __init__(self, http_status=None):
+        super().__init__("api error")
+        self.http_status = http_status
+
+
+def test_classify_error():
+    assert retry.classify_error(RateLimitError()) == retry.RATE_LIMIT
+    assert retry.classify_error(TimeoutError()) == retry.TIMEOUT
+    assert retry.classify_error(ConnectionError()) == retry.CONNECTION
+    assert retry.classify_error(APIError(502)) == retry.SERVER
+    assert retry.classify_error(APIError(429)) == retry.RATE_LIMIT
+    assert retry.classify_error(APIError(400)) is None
+    assert retry.classify_error(ValueError()) is None
+
+
+def test_parse_retry_after():
+    assert retry.parse_retry_after({"retry-after": "3"}) == 3
+    assert retry.parse_retry_after({"retry-after-ms": "1500"}) == 1.5
+    assert retry.parse_retry_after({}) is None
+    assert retry.parse_retry_after({"retry-after": "bad"}) is None
+
+
+def test_backoff_grows_and_stops_at_max_retries(clock):
+    state = RetryPolicy(max_retries=3, max_delay=100, deadline=1000).start(blocking=False)
+    delays = [state.next_delay(kind=retry.SERVER) for _ in range(4)]
+    # 基础等待2秒，每次翻倍，抖动范围为[backoff/2, backoff]
+    for delay, backoff in zip(delays, [2, 4, 8]):
+        assert backoff / 2 <= delay <= backoff
+    assert delays[3] is None
+
+
+def test_not_retryable_error(clock):
+    state = RetryPolicy(max_retries=3).start()
+    assert state.next_delay(ValueError()) is None
+    assert state.attempts == 0
+
+
+def test_retry_after_is_honoured(clock):
+    state = RetryPolicy(max_retries=3, max_delay=1, deadline=1000).start(blocking=False)
+    assert state.next_delay(RateLimitError({"retry-after": "20"})) == 20
+
+
+def test_sync_wait_is_capped(clock):
+    policy = RetryPolicy(max_retries=5, max_delay=100, deadline=1000, sync_max_wait=5)
+    # 同步等待时服务端要求的等待时间超出额度，直接放弃
+    assert policy.start().next_delay(RateLimitError({"retry-after": "20"})) is None
+    state = policy.start()
+    delays = [state.next_delay(kind=retry.RATE_LIMIT) for _ in range(3)]
+    assert delays[0] <= 5 and sum(d for d in delays if d) == pytest.approx(5)
+    assert None in delays
+
+
+def test_deadline_stops_retry(clock):
+    state = RetryPolicy(max_retries=10, max_delay=100, deadline=10).start()
+    clock.now += 9
+    assert state.next_delay(kind=retry.RATE_LIMIT) is None
+
+
+def test_attempts_continue_from_retry_count(clock):
+    state = RetryPolicy(max_retries=2).start(2)
+    assert state.next_delay(kind=retry.TIMEOUT) is None
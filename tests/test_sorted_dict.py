@@ -0,0 +1,78 @@
+import random
+
+from common.sorted_dict import SortedDict
+
+
+class Plugin:
+    def __init__(self, priority):
+        self.priority = priority
+
+
+def expected_order(d):
+    return [k for k, _ in sorted(dict.items(d), key=lambda item: (item[1].priority, item[0]), reverse=d.reverse)]
+
+
+def test_keys_sorted_by_priority():
+    d = SortedDict(lambda k, v: v.priority, reverse=True)
+    d["a"] = Plugin(1)
+    d["b"] = Plugin(3)
+    d["c"] = Plugin(2)
+    assert list(d.keys()) == ["b", "c", "a"]
+    assert [k for k, _ in d.items()] == ["b", "c", "a"]
+    assert list(d) == ["b", "c", "a"]
+
+
+def test_update_heap_after_priority_change():
+    d = SortedDict(lambda k, v: v.priority, reverse=True)
+    for name, priority in [("a", 1), ("b", 2), ("c", 3)]:
+        d[name] = Plugin(priority)
+    assert list(d.keys()) == ["c", "b", "a"]  # 生成缓存
+    d["a"].priority = 10
+    d._update_heap("a")
+    assert list(d.keys()) == ["a", "c", "b"]
+    assert [k for k, _ in d.items()] == ["a", "c", "b"]
+
+
+def test_delete_and_reinsert():
+    d = SortedDict(lambda k, v: v.priority, reverse=True)
+    for name, priority in [("a", 1), ("b", 2), ("c", 3)]:
+        d[name] = Plugin(priority)
+    assert list(d.keys()) == ["c", "b", "a"]
+    del d["b"]
+    assert list(d.keys()) == ["c", "a"]
+    assert "b" not in d
+    d["b"] = Plugin(0)
+    assert list(d.keys()) == ["c", "a", "b"]
+
+
+def test_items_reflect_new_value_with_same_priority():
+    d = SortedDict(lambda k, v: v["priority"], reverse=True)
+    d["a"] = {"priority": 1, "enabled": True}
+    assert d.items()[0][1]["enabled"]
+    d["a"] = {"priority": 1, "enabled": False}
+    assert not d.items()[0][1]["enabled"]
+
+
+def test_random_operations_match_sorted():
+    random.seed(0)
+    d = SortedDict(lambda k, v: v.priority, reverse=True)
+    for _ in range(2000):
+        op = random.random()
+        name = "p{}".format(random.randint(0, 30))
+        if op < 0.4:
+            d[name] = Plugin(random.randint(-5, 5))
+        elif op < 0.7 and name in dict.keys(d):
+            d[name].priority = random.randint(-5, 5)
+            d._update_heap(name)
+        elif name in dict.keys(d):
+            del d[name]
+        assert list(d.keys()) == expected_order(d)
+
+
+def test_keys_and_items_return_lists():
+    d = SortedDict(init_dict={"b": 2, "a": 1})
+    keys = d.keys()
+    assert keys == ["a", "b"]
+    keys.append("c")  # 修改返回值不影响缓存
+    assert d.keys() == ["a", "b"]
+    assert d.items() == [("a", 1), ("b", 2)]
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from common.state_backend import MemoryStateBackend, SqliteStateBackend
+from common.token_bucket import SharedTokenBucket, TokenBucket
+
+
+def test_starts_full_then_waits(clock):
+    bucket = TokenBucket(60)  # 每秒1个令牌
+    for _ in range(60):
+        assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(1.0)
+    # 预支的令牌按顺序排队
+    assert bucket.reserve() == pytest.approx(2.0)
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    clock.now += 30
+    assert bucket.reserve(30) == 0
+    clock.now += 3600
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_max_wait_rejects_without_reserving(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    assert bucket.reserve(5, max_wait=1) is None
+    assert bucket.reserve(1, max_wait=1) == pytest.approx(1.0)
+
+
+def test_release_returns_tokens(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    bucket.release(10)
+    assert bucket.reserve(10) == 0
+    # 归还的令牌不会超过容量
+    clock.now += 60
+    bucket.release(100)
+    assert bucket.tokens == 60
+
+
+def test_get_token_timeout(clock):
+    bucket = TokenBucket(60, timeout=0)
+    bucket.reserve(60)
+    assert not bucket.get_token()
+
+
+def test_shared_bucket_refill_and_release(clock, tmp_path):
+    backend = SqliteStateBackend(os.path.join(str(tmp_path), "state.db"))
+    first = SharedTokenBucket("chatgpt", 60, backend)
+    second = SharedTokenBucket("chatgpt", 60, backend)
+    assert first.reserve(60) == 0
+    # 同名令牌桶在实例间共享
+    assert second.reserve() == pytest.approx(1.0)
+    clock.now += 2
+    assert second.reserve() == pytest.approx(0.0)
+    first.release(5)
+    assert first.reserve(5) == 0
+
+
+def test_memory_backend_reserves_in_process(clock):
+    backend = MemoryStateBackend()
+    assert backend.reserve_tokens("chatgpt", 1, 60, 60) == 0
+    assert backend.reserve_tokens("chatgpt", 1, 60) == pytest.approx(1.0)
+    assert backend.reserve_tokens("chatgpt", 1, 60, 10, max_wait=5) is None
+    assert backend.reserve_tokens("other", 1, 60) == 0
+
+
+def test_shared_bucket_reserves_off_the_event_loop(clock, tmp_path):
+    backend = SqliteStateBackend(os.path.join(str(tmp_path), "state.db"))
+    bucket = SharedTokenBucket("chatgpt", 60, backend)
+    threads = []
+    reserve = backend.reserve_tokens
+
+    def reserve_tokens(*args):
+        threads.append(threading.current_thread())
+        return reserve(*args)
+
+    backend.reserve_tokens = reserve_tokens
+    assert asyncio.run(bucket.aget_token())
+    assert threads and threads[0] is not threading.current_thread()
+
+
+class FakeSession:
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def calc_tokens(self):
+        return self.tokens
+
+
+def test_admission_admits_oversize_request_when_full(clock):
+    from common.admission import TokenAdmission
+
+    admission = TokenAdmission("test", 600, max_wait=5, completion_tokens=100)
+    tokens = admission.estimate(FakeSession(2000))
+    assert tokens == 600
+    assert admission.admit(tokens)
+    admission.reconcile(tokens, 2100)  # 超出容量的部分补扣后需要等额度恢复
+    assert not admission.admit(admission.estimate(FakeSession(10)))
+    clock.now += 400
+    assert admission.admit(admission.estimate(FakeSession(10)))
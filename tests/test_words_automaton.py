@@ -0,0 +1,76 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "banwords", "lib"))
+
+from WordsAutomaton import WordsAutomaton  # noqa: E402
+from WordsSearch import WordsSearch  # noqa: E402
+
+
+def build(cls, words):
+    searcher = cls()
+    searcher.SetKeywords(words)
+    return searcher
+
+
+def find_all(searcher, text):
+    return sorted((r["End"], r["Keyword"], r["Index"]) for r in searcher.FindAll(text))
+
+
+def random_case(seed):
+    rng = random.Random(seed)
+    chars = "abcde中文敏感"
+    words = ["".join(rng.choice(chars) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 12))]
+    text = "".join(rng.choice(chars + "xyz") for _ in range(rng.randint(0, 60)))
+    return words, text
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_parity_with_words_search(seed):
+    words, text = random_case(seed)
+    old = build(WordsSearch, words)
+    new = build(WordsAutomaton, words)
+    assert new.ContainsAny(text) == old.ContainsAny(text)
+    assert find_all(new, text) == find_all(old, text)
+    assert new.Replace(text) == old.Replace(text)
+    first_old, first_new = old.FindFirst(text), new.FindFirst(text)
+    assert (first_new and (first_new["End"], first_new["Keyword"])) == (first_old and (first_old["End"], first_old["Keyword"]))
+
+
+def test_duplicate_words_report_every_index():
+    words = ["ab", "b", "ab"]
+    assert find_all(build(WordsAutomaton, words), "xab") == find_all(build(WordsSearch, words), "xab")
+
+
+def test_replace_merges_overlapping_words():
+    searcher = build(WordsAutomaton, ["abc", "cd"])
+    assert searcher.Replace("xabcdx") == "x****x"
+
+
+def test_save_load_round_trip(tmp_path):
+    words, text = random_case(1)
+    text += "".join(words)
+    searcher = build(WordsAutomaton, words)
+    path = os.path.join(str(tmp_path), "banwords.dat")
+    searcher.save(path, "hash1")
+    assert os.listdir(str(tmp_path)) == ["banwords.dat"]  # 临时文件已被替换
+    loaded = WordsAutomaton.load(path, "hash1")
+    assert loaded is not None
+    assert find_all(loaded, text) == find_all(searcher, text)
+    assert loaded.Replace(text) == searcher.Replace(text)
+
+
+def test_load_rejects_changed_source(tmp_path):
+    path = os.path.join(str(tmp_path), "banwords.dat")
+    build(WordsAutomaton, ["abc"]).save(path, "hash1")
+    assert WordsAutomaton.load(path, "hash2") is None
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = os.path.join(str(tmp_path), "banwords.dat")
+    with open(path, "wb") as f:
+        f.write(b"not an automaton")
+    assert WordsAutomaton.load(path) is None